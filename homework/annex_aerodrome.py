@@ -2,12 +2,24 @@ import os
 import json
 import re
 import hashlib
-from typing import List, Dict, Tuple, Optional, Any
-from collections import defaultdict
-from dataclasses import dataclass
+from typing import List, Dict, Tuple, Optional, Any, Callable
+from collections import defaultdict, OrderedDict
+from collections.abc import Mapping, Sequence
+from dataclasses import dataclass, asdict, field
 import warnings
 import sys
 import time
+import bisect
+import heapq
+import math
+import struct
+import mmap
+from array import array
+import threading
+import argparse
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 warnings.filterwarnings('ignore')
 
@@ -31,6 +43,8 @@ class SearchResult:
     confidence: float
     source_page: Optional[str] = None
     keywords: List[str] = None
+    chunk_id: Optional[int] = None
+    toc_path: str = ""  # 在目录树中的位置，如"第3章 物理特性 > 3.5 跑道端安全区"
 
 
 @dataclass
@@ -42,43 +56,1248 @@ class ConversationTurn:
     timestamp: float
 
 
-class EnhancedAttachment14ManualQA:
-    def __init__(self, manual_path: str, max_context_length: int = 32000):
+@dataclass
+class FigureInfo:
+    """图片/图表元数据"""
+    file_name: str
+    path: str
+    kind: str  # image / chart / table / formula
+    bbox: Tuple[int, int, int, int]  # 文件名中记录的页面裁剪框 (x1, y1, x2, y2)
+    width: int
+    height: int
+    caption: str = ""
+    chunk_id: Optional[int] = None
+    offset: Optional[int] = None  # 在手册全文中的引用位置
+
+
+FIGURE_FILE_PATTERN = re.compile(r'^img_in_(image|chart|table|formula)_box_(\d+)_(\d+)_(\d+)_(\d+)\.jpe?g$',
+                                 re.IGNORECASE)
+
+
+def read_jpeg_size(path: str) -> Optional[Tuple[int, int]]:
+    """只读取JPEG文件头中的SOF段获取宽高，不解码像素数据"""
+    try:
+        with open(path, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                # SOF0-SOF15（C4/C8/CC不是帧头）
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack('>3xHH', f.read(7))
+                    return width, height
+                segment_length = struct.unpack('>H', f.read(2))[0]
+                f.seek(segment_length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return None
+
+
+def load_figure_info(path: str) -> Optional[FigureInfo]:
+    """根据文件名解析图片类型和裁剪框，并读取图片尺寸"""
+    file_name = os.path.basename(path)
+    match = FIGURE_FILE_PATTERN.match(file_name)
+    if not match:
+        return None
+
+    bbox = tuple(int(v) for v in match.group(2, 3, 4, 5))
+    size = read_jpeg_size(path) or (bbox[2] - bbox[0], bbox[3] - bbox[1])
+    return FigureInfo(
+        file_name=file_name,
+        path=path,
+        kind=match.group(1).lower(),
+        bbox=bbox,
+        width=size[0],
+        height=size[1]
+    )
+
+
+INDEX_CACHE_FORMAT = 8  # 索引缓存格式版本，结构变化时递增
+
+APPENDIX_HEADING_PATTERN = re.compile(r'^##\s*(附录\s*\d+|附篇\s*[A-Z])\s*(.+)$')  # 附录/附篇与章同级
+
+DEFAULT_MANUAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "datas",
+                                   "附件14 机场  — 机场设计与运行_第I卷 (第九版，2022年7月)", "index.md")
+
+# 示例问题（交互模式下可输入序号选择，也用于bench）
+EXAMPLE_QUESTIONS = [
+    "跑道端安全区(RESA)的尺寸要求是什么？",
+    "PCN和ACN分别代表什么？如何计算？",
+    "跑道宽度和长度的基本要求是什么？",
+    "目视进近坡度指示系统(VASIS)的布置要求？",
+    "障碍物限制面包括哪些？各自的标准是什么？",
+    "滑行道的最小宽度要求是多少？",
+    "跑道标志和滑行道标志有什么区别？",
+    "机场灯光系统有哪些类型？",
+    "精密进近跑道和非精密进近跑道的区别？",
+    "机场道面强度报告PCN如何解读？"
+]
+
+# 事实表回归问题：(问题, 事实表直接作答时应给出的数值)，数值为None表示不应由事实表直接作答
+FACT_CHECK_CASES = [
+    ("跑道的横坡最大是多少？", None),  # 只有道肩"其横坡不大于2.5%"
+    ("跑道的纵坡最大是多少？", None),  # "其纵坡不大于0.8%"是两端的例外，主要限值在列表项里
+    ("跑道边灯的间距最大是多少？", None),  # 60m/100m取决于是否仪表跑道
+    ("精密进近跑道的最小宽度是多少？", "30m"),
+    ("侧风分量最大是多少？", None),  # 37km/h，刹车作用不良时才是24km/h
+    ("精密进近跑道的宽度最大是多少？", None),  # 条文规定的是下限"不小于30m"
+    ("新道面的平均表面纹理深度最大是多少？", None),  # 条文规定的是下限"不小于1mm"
+    ("滑行道的最小宽度要求是多少？", None),  # 同一主语下只有纵坡的事实
+    ("跑道端安全区的宽度至少是多少？", None),  # 90m是长度
+    ("在直线段上的间距最大是多少？", None),  # 截断的要求对象，缺少"引入线、转弯线的灯"
+    ("机场的跑道的长度最小是多少？", None),  # "机场的跑道条数和方位"的95%是机场利用率
+    ("新道面的平均表面纹理深度至少是多少？", "1mm"),
+]
+
+# 标题片段收入分词词典的最大长度，与术语定义的长度上限一致（"目视进近坡度指示系统"、"跑道侵入自主警告系统"）
+HEADING_WORD_MAX_LENGTH = 12
+
+# 关键词提取时过滤的常见词和疑问短语；分词前先在这些短语处断开，避免产生"有什"、"么区"之类跨词的二元组。
+# 只收多字短语，"有"、"吗"这样的单字会切断"有效长度"、"有关障碍灯"中的真实词语，句末语气词单独处理
+KEYWORD_STOP_WORDS = ['可以', '一个', '进行', '需要', '要求', '如果', '应当', '必须', '不得',
+                      '有什么', '有哪些', '有没有', '有何', '为什么', '是什么', '什么', '怎么', '怎样',
+                      '多少', '哪些', '如何', '是否']
+KEYWORD_STOP_PATTERN = re.compile('|'.join(KEYWORD_STOP_WORDS) + r'|[吗呢](?=[？?。！!\s]|$)')
+
+# 机场特定术语
+AIRPORT_TERMS = ['跑道', '滑行道', '机坪', '航站楼', '灯光', '标志', '标记', '道面',
+                 '净空', '障碍物', 'ILS', 'VOR', 'NDB', 'PCN', 'ACN', 'RESA',
+                 '跑道端安全区', '升降带', '精密进近', '非精密进近']
+
+
+class ChineseAnalyzer:
+    """基于词典的中文分词器：Trie最长匹配，未登录片段回退为字符二元组"""
+
+    _END = None  # Trie中标记词尾的键
+    _FUNCTION_CHARS = set('的了和与及或是在对为其')  # 二元组中包含这些虚字时丢弃
+
+    def __init__(self, words: Optional[List[str]] = None):
+        self._trie: Dict = {}
+        self.size = 0
+        for word in words or []:
+            self.add_word(word)
+
+    def add_word(self, word: str):
+        """向词典添加一个词"""
+        if len(word) < 2:
+            return
+        node = self._trie
+        for char in word:
+            node = node.setdefault(char, {})
+        if self._END not in node:
+            node[self._END] = True
+            self.size += 1
+
+    def _match_lengths(self, text: str, start: int, end: int) -> List[int]:
+        """返回从start开始（不超过end）能匹配的所有词典词长度，从短到长"""
+        lengths = []
+        node = self._trie
+        for i in range(start, end):
+            node = node.get(text[i])
+            if node is None:
+                break
+            if self._END in node:
+                lengths.append(i - start + 1)
+        return lengths
+
+    def is_word(self, token: str) -> bool:
+        """token是否为词典词（而非未登录片段的字符二元组）"""
+        return len(token) in self._match_lengths(token, 0, len(token))
+
+    def _bigrams(self, run: str) -> List[str]:
+        """未登录片段切分为字符二元组"""
+        return [run[i:i + 2] for i in range(len(run) - 1)
+                if not (run[i] in self._FUNCTION_CHARS or run[i + 1] in self._FUNCTION_CHARS)]
+
+    def segment(self, run: str) -> List[str]:
         """
-        增强版附件14手册问答系统
+        对连续中文片段分词
+
+        正向最长匹配得到词典词，同时输出其内部嵌套的较短词典词（如"跑道端安全区"中的"跑道"），
+        未被词典覆盖的片段输出字符二元组。
+        """
+        tokens = []
+        unmatched_start = None
+        i = 0
+        while i < len(run):
+            lengths = self._match_lengths(run, i, len(run))
+            if not lengths:
+                if unmatched_start is None:
+                    unmatched_start = i
+                i += 1
+                continue
+
+            if unmatched_start is not None:
+                tokens.extend(self._bigrams(run[unmatched_start:i]))
+                unmatched_start = None
+
+            word_len = lengths[-1]
+            tokens.append(run[i:i + word_len])
+            for j in range(i, i + word_len):
+                for inner_len in self._match_lengths(run, j, i + word_len):
+                    if inner_len < word_len:
+                        tokens.append(run[j:j + inner_len])
+            i += word_len
+
+        if unmatched_start is not None:
+            tokens.extend(self._bigrams(run[unmatched_start:]))
+        return tokens
+
+    def analyze(self, text: str) -> List[str]:
+        """分析文本，返回中文词元和英文/缩写词元（保留原顺序和重复）"""
+        tokens = []
+        for match in re.finditer(r'[\u4e00-\u9fa5]+|[A-Za-z][A-Za-z0-9]+', text):
+            piece = match.group(0)
+            if piece[0].isascii():
+                tokens.append(piece)
+            else:
+                tokens.extend(self.segment(piece))
+        return tokens
+
+
+def extract_keywords(text: str, analyzer: ChineseAnalyzer, max_keywords: int = 20, min_freq: int = 2) -> List[str]:
+    """
+    从文本中提取关键词（缩写、分词得到的中文术语、章节/图表编号、机场特定术语）
+
+    未登录片段的重叠二元组（"目视/视进/进近"）只隔一个取一个，截断到max_keywords前词典词排在
+    二元组之前，二元组不会挤掉真正的术语。
+    """
+    keywords = {}  # 用dict保持提取顺序
+
+    # 提取大写缩写
+    abbreviations = re.findall(r'\b[A-Z]{2,}[A-Z0-9/]*\b', text)
+    keywords.update(dict.fromkeys(abbreviations))
+
+    # 中文专业术语：与索引使用同一分词器，在常见词和疑问词处先断开
+    chinese_terms = [token for token in analyzer.analyze(KEYWORD_STOP_PATTERN.sub(' ', text))
+                     if not token.isascii()]
+    bigrams = set()
+    previous_bigram = None
+    for term in chinese_terms:
+        is_bigram = not analyzer.is_word(term)
+        if is_bigram and previous_bigram and previous_bigram[1] == term[0]:
+            previous_bigram = None
+            continue
+        previous_bigram = term if is_bigram else None
+        # 只保留出现频率较高的术语
+        if len(term) >= 2 and text.count(term) >= min_freq:
+            keywords[term] = None
+            if is_bigram:
+                bigrams.add(term)
+
+    # 提取数字相关术语
+    number_refs = re.findall(r'(?:第[一二三四五六七八九十\d]+章|第\d+\.\d+条|表\d+\.\d+|图\d+\.\d+)', text)
+    keywords.update(dict.fromkeys(number_refs))
+
+    # 机场特定术语
+    for term in AIRPORT_TERMS:
+        if term in text:
+            keywords[term] = None
+            bigrams.discard(term)
+
+    return sorted(keywords, key=lambda keyword: keyword in bigrams)[:max_keywords]
+
+
+def analyze_chunk(text: str, analyzer: ChineseAnalyzer) -> Tuple[List[str], List[str]]:
+    """分析一个内容块，返回(关键词, 倒排索引词项)"""
+    keywords = extract_keywords(text, analyzer)
+    terms = {token.lower() for token in analyzer.analyze(text)}
+    terms.update(keyword.lower() for keyword in keywords)
+    return keywords, sorted(terms)
+
+
+_worker_analyzer: Optional[ChineseAnalyzer] = None  # 并行建索引时每个子进程持有的分词器
+
+
+def print_progress(message: str):
+    """进度信息写到标准错误，标准输出只留给答案和JSON结果"""
+    print(message, file=sys.stderr, flush=True)
+
+
+def _init_analysis_worker(analyzer: ChineseAnalyzer):
+    global _worker_analyzer
+    _worker_analyzer = analyzer
+
+
+def _analyze_chunk_in_worker(text: str) -> Tuple[List[str], List[str]]:
+    return analyze_chunk(text, _worker_analyzer)
+
+
+# 大模型调用的固定前缀：系统提示和回答要求在所有调用中保持不变，便于服务端前缀缓存
+SYSTEM_PROMPT = "你是国际民航组织附件14（机场设计与运行）专家，专门为机场工作人员提供专业指导。用中文回答，保持专业但易懂。"
+
+ANSWER_INSTRUCTIONS = """你是一名国际民航组织附件14（机场设计与运行）的专家。基于提供的手册内容回答问题。
+
+请按以下要求回答：
+1. 提供专业、准确的回答，直接针对问题
+2. 引用具体来源（章节号、小节号）
+3. 如果信息不完整，基于相关知识给出可能的答案，并说明不确定性
+4. 回答要具体，避免模糊表述
+5. 对于操作性问题，给出具体步骤或标准
+6. 如果相关，提及相关表格或图表"""
+
+
+ANSWER_MAX_TOKENS = 2000  # 单次回答的最大token数
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中文约1字1个token，其余字符约4个1个token"""
+    cjk_count = len(re.findall(r'[\u4e00-\u9fff\u3000-\u303f\uff00-\uffef]', text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+
+class PromptAssembler:
+    """
+    多轮对话的prompt组装器
+
+    消息顺序固定为：系统提示 -> 回答要求 -> 按块序号排序的手册内容 -> 问题，
+    之后的轮次以真实的多轮消息追加，只发送此前未发送过的内容，已发送过的相同片段只给出编号引用，
+    使每次请求的前缀与上一次请求完全一致。内容按(块序号, 片段文本)去重：同一块中与问题相关的
+    片段不同时作为新内容发送，编号仍为块序号。块序号只在同一索引版本内有意义，
+    手册重新加载后的第一轮整体重置；带上历史轮次后超出prompt预算时同样整体重置。
+    """
+
+    def __init__(self, max_turns: int = 5):
+        """
+        Args:
+            max_turns: 保留的最大对话轮数，超出后整体重置（重新发送完整前缀）
+        """
+        self.max_turns = max_turns
+        self.messages: List[Dict] = []  # 已完成轮次的user/assistant消息
+        self.sent_blocks = set()  # 已发送的(块序号, 片段文本)
+        self.index_version: Optional[int] = None  # 已发送内容所属的索引版本
+
+    def reset(self):
+        """清空多轮消息和已发送内容记录"""
+        self.messages = []
+        self.sent_blocks = set()
+
+    def build(self, question: str, blocks: List[Tuple[int, str]], definitions: List[str],
+              index_version: Optional[int] = None,
+              max_prompt_tokens: Optional[int] = None) -> Tuple[List[Dict], Dict]:
+        """
+        组装本轮请求消息
+
+        Args:
+            question: 当前问题
+            blocks: [(块序号, 与问题相关的片段), ...]
+            definitions: 相关定义
+            index_version: blocks所属的索引版本，与已发送内容的版本不同时先重置
+            max_prompt_tokens: prompt的估算token上限，带上历史轮次后超出时重置，只发送本轮内容
+
+        Returns:
+            (消息列表, 本轮内容块统计)
+        """
+        if len(self.messages) >= self.max_turns * 2 or index_version != self.index_version:
+            self.reset()
+            self.index_version = index_version
+
+        messages, block_stats = self._assemble(question, blocks, definitions)
+        if (max_prompt_tokens and self.messages
+                and sum(estimate_tokens(message["content"]) for message in messages) > max_prompt_tokens):
+            self.reset()
+            messages, block_stats = self._assemble(question, blocks, definitions)
+        return messages, block_stats
+
+    def _assemble(self, question: str, blocks: List[Tuple[int, str]],
+                  definitions: List[str]) -> Tuple[List[Dict], Dict]:
+        """在当前历史轮次之后组装本轮消息"""
+        new_blocks = sorted(block for block in blocks if block not in self.sent_blocks)
+        reused_ids = sorted(chunk_id for chunk_id, text in blocks if (chunk_id, text) in self.sent_blocks)
+
+        parts = []
+        if not self.messages:
+            parts.append(ANSWER_INSTRUCTIONS)
+        if new_blocks:
+            parts.append("相关手册内容:\n\n" + '\n\n'.join(f"[块{chunk_id}] {text}" for chunk_id, text in new_blocks))
+        if reused_ids:
+            parts.append("前文已提供的相关内容: " + "、".join(f"[块{chunk_id}]" for chunk_id in reused_ids))
+        if definitions:
+            parts.append("相关定义:\n" + '\n'.join(definitions))
+        parts.append(f"当前问题：{question}\n\n专业回答：")
+
+        user_message = {"role": "user", "content": '\n\n'.join(parts)}
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}] + self.messages + [user_message]
+        block_stats = {
+            "new_blocks": new_blocks,
+            "reused_blocks": reused_ids
+        }
+        return messages, block_stats
+
+    def commit(self, messages: List[Dict], answer: str, block_stats: Dict):
+        """记录已成功完成的一轮，供后续轮次复用前缀"""
+        self.messages.append(messages[-1])
+        self.messages.append({"role": "assistant", "content": answer})
+        self.sent_blocks.update(block_stats["new_blocks"])
+
+
+@dataclass
+class RequirementFact:
+    """从规范条文中抽取的数值要求"""
+    subject: str  # 要求对象，如"精密进近跑道的宽度"
+    condition: str  # 适用条件，如"基准代码为1或2"
+    comparator: str  # 不小于 / 不大于 / 为
+    value: float
+    unit: str
+    section: str
+    chapter: str
+    chunk_id: int
+    sentence: str
+
+    def value_text(self) -> str:
+        value = int(self.value) if self.value == int(self.value) else self.value
+        return f"{value}{self.unit}"
+
+
+REQUIREMENT_MARKERS = ('应', '必须', '不得')
+FACT_VALUE_PATTERN = re.compile(r'(\d+(?: \d{3})*(?:\.\d+)?)\s*(km/h|kt|km|cm|mm|m|%|°)(?![A-Za-z/])')
+FACT_COMPARATORS = [
+    ('不得小于', '不小于'), ('不应小于', '不小于'), ('不应少于', '不小于'), ('不小于', '不小于'), ('不少于', '不小于'),
+    ('不低于', '不小于'), ('至少', '不小于'),
+    ('不得大于', '不大于'), ('不得超过', '不大于'), ('不应大于', '不大于'), ('不应超过', '不大于'),
+    ('不大于', '不大于'), ('不超过', '不大于'),
+    ('应为', '为'), ('必须为', '为')
+]
+FACT_CONDITION_PATTERN = re.compile(r'((?:基准)?代[码字]为?\s*[A-F\d](?:\s*[、,，或和及至]\s*[A-F\d])*|'
+                                    r'外侧主起落架轮距[^，,。；的]*)')
+# 数值类问题的特征词，以及匹配事实前从问题中去掉的疑问/比较词
+FACT_QUESTION_PATTERN = re.compile(r'多少|多大|多宽|多长|多高|多远|最小|最大|至少|最少|不小于|不大于|几米')
+# 问题问的是上限还是下限：只有比较方向相同（或条文规定为定值）的事实才能回答
+FACT_QUESTION_DIRECTIONS = [
+    (re.compile(r'最大|最多|最高|最长|最宽|至多|不大于|不超过|上限'), '不大于'),
+    (re.compile(r'最小|最少|最低|最短|最窄|至少|不小于|不少于|下限'), '不小于'),
+]
+# 以代词/连词（"其横坡"、"但"）或介词/动词（"在直线段上的间距"、"将该系统的轴线"）开头的要求对象
+# 是截断的句子片段，说的是什么不在对象本身中
+FACT_FRAGMENT_SUBJECT = re.compile(r'^[其但以而仅或此在将从每使当对按由把用]')
+# 条件抽取未覆盖的条件从句：条文中出现时事实只是部分答案
+FACT_UNPARSED_CONDITION = re.compile(r'除了|除[^，,。；]*外|如为|如非|如果|若|当[^，,。；]*时')
+FACT_QUESTION_NOISE = re.compile(r'多少|多大|多宽|多长|多高|多远|最小|最大|至少|最少|不小于|不大于|几米|'
+                                 r'要求|标准|规定|是什么|是|的|吗|？|\?')
+
+
+def _fact_comparator(text: str) -> Tuple[int, str]:
+    """返回(比较词在文本中的位置, 归一化比较词)，没有比较词时位置为-1"""
+    best = (-1, '为')
+    for word, normalized in FACT_COMPARATORS:
+        position = text.find(word)
+        if position >= 0 and (best[0] < 0 or position < best[0]):
+            best = (position, normalized)
+    return best
+
+
+def _clean_fact_subject(text: str) -> str:
+    """去掉条文编号、"建议："、列表符号和条件短语，得到要求对象"""
+    text = re.sub(r'^[\s\da-zA-Z]*(?:\.\d+)*\s*[\.、）)]?\s*(?:建议[：:])?', '', text)
+    text = FACT_CONDITION_PATTERN.sub('', text)
+    text = re.split(r'应(?!急|用)|必须|不得', text)[0]
+    text = re.sub(r'^[一—\-\s的时，,]+|[的时，,\s]+$', '', text)
+    return text.strip()
+
+
+def extract_requirement_facts(chunk: Dict, chunk_id: int) -> List[RequirementFact]:
+    """
+    从内容块中抽取数值要求：含"应/必须/不得"且带数值和单位的条文句子，
+    以及以"："结尾、后面逐行列出"条件—数值"的条文
+    """
+    facts = []
+    lines = [line.strip() for line in chunk["content"].split('\n')]
+    lines = [line for line in lines if line and not line.startswith('<') and not line.startswith('#')]
+
+    for line_no, line in enumerate(lines):
+        for sentence in re.split(r'(?<=[。；;])', line):
+            if not any(marker in sentence for marker in REQUIREMENT_MARKERS):
+                continue
+            conditions = [match.strip() for match in FACT_CONDITION_PATTERN.findall(sentence)]
+            clauses = [clause for clause in re.split(r'[，,]', sentence) if clause.strip()]
+
+            # 条文后逐行列出的"条件—数值"
+            if sentence.rstrip().endswith(('：', ':')) and not FACT_VALUE_PATTERN.search(sentence):
+                position, comparator = _fact_comparator(clauses[-1])
+                subject = _clean_fact_subject(clauses[-1][:position] if position >= 0 else clauses[-1])
+                for item in lines[line_no + 1:line_no + 9]:
+                    item_match = re.match(r'^[一—\-\s]*(.+?)\s*[—–\-]+\s*' + FACT_VALUE_PATTERN.pattern, item)
+                    if not item_match:
+                        break
+                    condition = re.sub(r'^的|的$', '', item_match.group(1).strip())
+                    facts.append(RequirementFact(
+                        subject=subject, condition=condition, comparator=comparator,
+                        value=float(item_match.group(2).replace(' ', '')), unit=item_match.group(3),
+                        section=chunk.get("section", ""), chapter=chunk.get("chapter", ""),
+                        chunk_id=chunk_id, sentence=sentence.strip()
+                    ))
+                continue
+
+            previous_subject = ""
+            for clause in clauses:
+                value_match = FACT_VALUE_PATTERN.search(clause)
+                position, comparator = _fact_comparator(clause)
+                if not value_match:
+                    previous_subject = _clean_fact_subject(clause) or previous_subject
+                    continue
+
+                # 只接受数值前有明确比较词的要求，排除"宽度超过60m时"之类的条件描述
+                if not 0 <= position < value_match.start():
+                    previous_subject = _clean_fact_subject(clause) or previous_subject
+                    continue
+                subject = _clean_fact_subject(clause[:position]) or previous_subject
+                if len(re.findall(r'[一-龥]', subject)) < 2:
+                    continue
+                facts.append(RequirementFact(
+                    subject=subject, condition="；".join(dict.fromkeys(conditions)), comparator=comparator,
+                    value=float(value_match.group(1).replace(' ', '')), unit=value_match.group(2),
+                    section=chunk.get("section", ""), chapter=chunk.get("chapter", ""),
+                    chunk_id=chunk_id, sentence=sentence.strip()
+                ))
+                previous_subject = subject
+
+    return facts
+
+
+class FactTable:
+    """数值要求事实表：按要求对象和条文的词项建倒排索引，用于数值类问题的直接作答"""
+
+    def __init__(self, facts: List[RequirementFact], analyzer: ChineseAnalyzer):
+        self.facts = facts
+        self.analyzer = analyzer
+        self._subject_terms = [self._terms(fact.subject) for fact in facts]
+        self._subject_heads = [self._terms(fact.subject.partition('的')[0]) for fact in facts]
+        self._subject_tails = [self._attribute_terms(fact.subject, with_chars=True) for fact in facts]
+        self._sentence_terms = [self._terms(fact.sentence) | terms
+                                for fact, terms in zip(facts, self._subject_terms)]
+        self.term_index: Dict[str, List[int]] = defaultdict(list)
+        for i, terms in enumerate(self._sentence_terms):
+            # 要求对象是片段或不足两个实词时无法判断它说的是什么，不参与匹配
+            if FACT_FRAGMENT_SUBJECT.match(facts[i].subject) or len(self._subject_terms[i]) < 2:
+                continue
+            for term in terms:
+                self.term_index[term].append(i)
+
+    def __len__(self) -> int:
+        return len(self.facts)
+
+    def _terms(self, text: str) -> set:
+        return {token.lower() for token in self.analyzer.analyze(text) if len(token) >= 2}
+
+    def _attribute_terms(self, text: str, with_chars: bool = False) -> set:
+        """
+        最后一个"的"之后的属性词项
+
+        问题的属性只有单字（"长和宽"）时取这些字；要求对象（with_chars=True）同时带上单字，
+        使单字属性也能匹配，而"长度"与"坡度"这样的词项不会因为共有一个字而相互匹配。
+        """
+        if '的' not in text:
+            return set()
+        attribute = FACT_QUESTION_NOISE.sub(' ', text.rpartition('的')[2])
+        terms = self._terms(attribute)
+        chars = set(re.findall(r'[\u4e00-\u9fa5]', attribute)) - set('和与及或')
+        return terms | chars if with_chars else terms or chars
+
+    def lookup(self, question: str) -> Tuple[List[RequirementFact], float]:
+        """
+        查找与数值类问题匹配的事实
+
+        置信度 = 0.7 × 问题词项被条文覆盖的比例 + 0.3 × 要求对象词项被问题覆盖的比例。
+        问题的主语（"的"之前的部分，如"跑道的横坡"中的"跑道"）必须与要求对象的主语相同，
+        只出现在条文其他位置或作为更长主语的一部分（"精密进近跑道"）都不算匹配；
+        问题问的属性（最后一个"的"之后的部分，如"横坡"）必须与要求对象最后一个"的"之后的部分有共同词项。
+        问题问最大值时只接受"不大于"和定值的事实，问最小值时只接受"不小于"和定值的事实
+        （以问题中最后出现的最大/最小类词为准）。
+        条文带有未解析的条件从句（"除了…"、"如为…"），或同一条件下有多个不同数值时，
+        事实只是部分答案，置信度减半。问题中带有基准代码/代字条件时，只保留条件相符的事实。
+
+        Returns:
+            (同一条文中同一要求对象的全部事实, 置信度)，无匹配时返回([], 0.0)
+        """
+        if not FACT_QUESTION_PATTERN.search(question):
+            return [], 0.0
+
+        question_conditions = FACT_CONDITION_PATTERN.findall(question)
+        codes = set(re.findall(r'[A-F\d]', ''.join(question_conditions)))
+        question_text = FACT_CONDITION_PATTERN.sub(' ', question)
+        question_terms = self._terms(FACT_QUESTION_NOISE.sub(' ', question_text))
+        if not question_terms:
+            return [], 0.0
+        head = question_text.partition('的')[0]
+        main_terms = self._terms(FACT_QUESTION_NOISE.sub(' ', head)) or question_terms
+        attribute_terms = self._attribute_terms(question_text)
+        direction_matches = [(match.start(), direction) for pattern, direction in FACT_QUESTION_DIRECTIONS
+                             for match in pattern.finditer(question)]
+        allowed_comparators = {max(direction_matches)[1], '为'} if direction_matches else None
+
+        candidates = set()
+        for term in question_terms:
+            candidates.update(self.term_index.get(term, []))
+
+        best_id, best_confidence = None, 0.0
+        for i in sorted(candidates):
+            subject_terms = self._subject_terms[i]
+            if main_terms != self._subject_heads[i]:
+                continue
+            if attribute_terms and not attribute_terms & self._subject_tails[i]:
+                continue
+            if allowed_comparators and self.facts[i].comparator not in allowed_comparators:
+                continue
+            coverage = len(question_terms & self._sentence_terms[i]) / len(question_terms)
+            precision = len(question_terms & subject_terms) / len(subject_terms)
+            confidence = 0.7 * coverage + 0.3 * precision
+            if confidence > best_confidence:
+                best_id, best_confidence = i, confidence
+
+        if best_id is None:
+            return [], 0.0
+
+        best = self.facts[best_id]
+        group = [fact for fact in self.facts
+                 if fact.chunk_id == best.chunk_id and fact.subject == best.subject
+                 and (not allowed_comparators or fact.comparator in allowed_comparators)]
+        if codes:
+            group = [fact for fact in group if codes & set(re.findall(r'[A-F\d]', fact.condition))]
+        if not group:
+            return [], 0.0
+        values_by_condition = defaultdict(set)
+        for fact in group:
+            values_by_condition[fact.condition].add((fact.value, fact.unit))
+        if (FACT_UNPARSED_CONDITION.search(best.sentence)
+                or any(len(values) > 1 for values in values_by_condition.values())):
+            best_confidence *= 0.5
+        return group, best_confidence
+
+
+def osa_distance(a: str, b: str) -> int:
+    """编辑距离（允许相邻字符换位，即Damerau-Levenshtein的OSA变体）"""
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[len(b)]
+
+
+class QueryExpander:
+    """
+    查询扩展表：缩写与中文名称、英文全称互为同义写法，拼错的缩写按编辑距离纠正，词项到目录条目的表用于搜索建议
+
+    所有表都在建索引时一次构建，查询时只做字典查找和少量子串比较，耗时为微秒级。
+    纠错采用SymSpell的删除索引：预先生成每个缩写删除至多max_distance个字符后的变体，
+    查询词的删除变体与之相交即得到候选，再用编辑距离确认。
+    """
+
+    def __init__(self, structure: Dict, keyword_index: Mapping, analyzer: ChineseAnalyzer):
+        self.keyword_index = keyword_index
+        self.groups: Dict[str, Tuple[str, ...]] = {}  # 缩写小写/中文名称 -> (缩写, 中文名称)
+        self.phrases: List[Tuple[str, Tuple[str, ...]]] = []  # (英文全称小写, 同义写法)
+        self.chinese_names: List[Tuple[str, Tuple[str, ...]]] = []
+        for abbr, (english, chinese) in structure["abbreviations"].items():
+            if not re.fullmatch(r'[A-Z][A-Z0-9/\-]+', abbr):  # 计量单位等小写缩写不参与扩展
+                continue
+            forms = (abbr, chinese) if chinese else (abbr,)
+            self.groups[abbr.lower()] = forms
+            self.phrases.append((english.lower(), forms))
+            if chinese:
+                self.groups[chinese] = forms
+                self.chinese_names.append((chinese, forms))
+
+        self.deletes: Dict[str, List[str]] = defaultdict(list)  # 删除变体 -> 缩写小写
+        for word in self.groups:
+            if word.isascii():
+                for variant in self._deletes(word, self._max_distance(word)):
+                    self.deletes[variant].append(word)
+
+        # 目录条目：章（附录）为"第3章 物理特性"，节和子节带上所属章，如"第3章 3.5 跑道端安全区"
+        self.headings: List[str] = []
+        self.heading_index: Dict[str, List[int]] = defaultdict(list)  # 标题词项 -> 目录条目序号
+        for item in structure["toc"]:
+            if item["type"] in ("chapter", "appendix"):
+                label = f"{item['number']} {item['title']}"
+            else:
+                label = f"{item['chapter']} {item['number']} {item['title']}"
+            for token in dict.fromkeys(token.lower() for token in analyzer.analyze(item["title"])):
+                if len(token) >= 2:
+                    self.heading_index[token].append(len(self.headings))
+            self.headings.append(label)
+
+    @staticmethod
+    def _max_distance(word: str) -> int:
+        return 1 if len(word) <= 4 else 2
+
+    @staticmethod
+    def _deletes(word: str, distance: int) -> set:
+        """word删除至多distance个字符得到的全部变体（含word本身）"""
+        variants = {word}
+        frontier = {word}
+        for _ in range(distance):
+            frontier = {w[:i] + w[i + 1:] for w in frontier if len(w) > 1 for i in range(len(w))}
+            variants |= frontier
+        return variants
+
+    def correct(self, word: str) -> Optional[str]:
+        """把拼错的缩写纠正为编辑距离最小的已知缩写，没有足够接近的候选时返回None"""
+        word = word.lower()
+        max_distance = self._max_distance(word)
+        best, best_distance = None, max_distance + 1
+        for variant in self._deletes(word, max_distance):
+            for candidate in self.deletes.get(variant, []):
+                distance = osa_distance(word, candidate)
+                if distance < best_distance:
+                    best, best_distance = candidate, distance
+        return self.groups[best][0] if best else None
+
+    def expand(self, query: str) -> Tuple[List[str], Dict[str, str]]:
+        """
+        扩展查询
+
+        Returns:
+            (查询中没有出现的同义写法, {拼错的写法: 纠正后的缩写})
+        """
+        terms: Dict[str, None] = {}
+        corrections: Dict[str, str] = {}
+        lowered = query.lower()
+
+        if re.search(r'[A-Za-z]', query):
+            for word in re.findall(r'[A-Za-z][A-Za-z0-9/\-]*', query):
+                key = word.lower()
+                if key not in self.groups and len(key) >= 3 and key not in self.keyword_index:
+                    corrected = self.correct(key)
+                    if corrected:
+                        corrections[word] = corrected
+                        key = corrected.lower()
+                terms.update(dict.fromkeys(self.groups.get(key, ())))
+            for phrase, forms in self.phrases:
+                if phrase in lowered:
+                    terms.update(dict.fromkeys(forms))
+
+        for name, forms in self.chinese_names:
+            if name in query:
+                terms.update(dict.fromkeys(forms))
+
+        return [term for term in terms if term.lower() not in lowered], corrections
+
+    def suggest_headings(self, keywords: List[str], limit: int = 5) -> List[str]:
+        """按关键词命中的目录条目给出建议，出现在越少标题中的词权重越高"""
+        scores: Dict[int, float] = defaultdict(float)
+        for keyword in dict.fromkeys(keyword.lower() for keyword in keywords):
+            entries = self.heading_index.get(keyword, [])
+            for entry in entries:
+                scores[entry] += 1 / len(entries)
+        ranked = sorted(scores, key=lambda entry: (-scores[entry], entry))
+        return list(dict.fromkeys(self.headings[entry] for entry in ranked))[:limit]
+
+
+class QueryResultCache:
+    """检索结果缓存（LRU + TTL），索引版本变化时自动失效"""
+
+    def __init__(self, max_entries: int = 256, ttl: float = 600.0):
+        """
+        Args:
+            max_entries: 最多缓存的查询条数
+            ttl: 缓存有效期（秒）
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_version = None
+        self._entries: OrderedDict = OrderedDict()  # key -> (写入时间, [(块序号, 分数), ...])
+        self._lock = threading.Lock()  # 多个会话线程共享同一缓存
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _check_version(self, index_version: int) -> bool:
+        """出现更新的索引版本时清空全部缓存；返回index_version是否为当前版本（旧快照上的查询不读写缓存）"""
+        if self.index_version is None or index_version > self.index_version:
+            self._entries.clear()
+            self.index_version = index_version
+        return index_version == self.index_version
+
+    def get(self, key: Tuple, index_version: int) -> Optional[List[Tuple[int, float]]]:
+        """查询缓存，未命中或已过期返回None"""
+        with self._lock:
+            entry = self._entries.get(key) if self._check_version(index_version) else None
+            if entry is None:
+                self.misses += 1
+                return None
+
+            stored_at, ranked = entry
+            if time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return ranked
+
+    def put(self, key: Tuple, index_version: int, ranked: List[Tuple[int, float]]):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        with self._lock:
+            if not self._check_version(index_version):
+                return
+            self._entries[key] = (time.time(), list(ranked))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict:
+        """缓存统计信息"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+
+# 紧凑索引文件：文件头 + 8个按8字节对齐的数据段，数组段按本机字节序存放，可经mmap直接映射为定宽数组
+COMPACT_INDEX_MAGIC = b'A14CIDX\x00'
+COMPACT_INDEX_FORMAT = 1
+COMPACT_INDEX_HEADER = struct.Struct('<8sBxxxIII16Q')  # 魔数、大端标志、格式版本、词项数、块数、8段(偏移, 长度)
+COMPACT_CHUNK_FIELDS = 5  # 块元数据：起始偏移、结束偏移、章节串号、小节串号、关键词串号
+
+
+def encode_postings(postings: List[int]) -> bytes:
+    """倒排表编码：升序块序号取差值后按varint（每字节7位，最高位表示后续还有字节）写出"""
+    data = bytearray()
+    previous = 0
+    for doc in postings:
+        gap = doc - previous
+        previous = doc
+        while gap >= 0x80:
+            data.append((gap & 0x7F) | 0x80)
+            gap >>= 7
+        data.append(gap)
+    return bytes(data)
+
+
+def decode_postings(data) -> List[int]:
+    """解码encode_postings写出的倒排表"""
+    postings = []
+    doc = value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            doc += value
+            postings.append(doc)
+            value = shift = 0
+    return postings
+
+
+def is_compact_index(path: str) -> bool:
+    """按文件头魔数判断是否为紧凑索引文件"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(COMPACT_INDEX_MAGIC)) == COMPACT_INDEX_MAGIC
+    except OSError:
+        return False
+
+
+class CompactChunks(Sequence):
+    """紧凑索引中的内容块：元数据为定宽数组，访问时才从手册全文切出块内容"""
+
+    def __init__(self, records: memoryview, strings: 'CompactStrings', content: str):
+        self._records = records
+        self._strings = strings
+        self._content = content
+
+    def __len__(self) -> int:
+        return len(self._records) // COMPACT_CHUNK_FIELDS
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+
+        base = i * COMPACT_CHUNK_FIELDS
+        start, end, chapter, section, keywords = self._records[base:base + COMPACT_CHUNK_FIELDS]
+        keywords_text = self._strings[keywords]
+        return {
+            "content": self._content[start:end],
+            "chapter": self._strings[chapter],
+            "section": self._strings[section],
+            "keywords": keywords_text.split('\x1f') if keywords_text else [],
+            "start": start,
+            "end": end
+        }
+
+
+class CompactStrings:
+    """字符串表：偏移数组 + UTF-8数据段"""
+
+    def __init__(self, offsets: memoryview, blob: memoryview):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return str(self._blob[self._offsets[i]:self._offsets[i + 1]], 'utf-8')
+
+
+class CompactIndex(Mapping):
+    """
+    以mmap只读打开的紧凑索引（词项 -> 升序块序号），可直接替代keyword_index
+
+    词典为按UTF-8字节排序的词项表，查找时二分；倒排表为差值+varint编码，查到词项后才解码。
+    所有数组段都是映射内存上的零拷贝视图，打开文件只解析文件头和元数据，多个进程共享操作系统页缓存。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, big_endian, fmt, term_count, chunk_count, *spans = COMPACT_INDEX_HEADER.unpack_from(self._mmap, 0)
+        if magic != COMPACT_INDEX_MAGIC or fmt != COMPACT_INDEX_FORMAT:
+            raise ValueError(f"不支持的紧凑索引格式: {path}")
+        if big_endian != (sys.byteorder == 'big'):
+            raise ValueError(f"紧凑索引的字节序与本机不一致: {path}")
+
+        view = memoryview(self._mmap)
+        sections = [view[spans[2 * i]:spans[2 * i] + spans[2 * i + 1]] for i in range(8)]
+        self.meta = json.loads(str(sections[0], 'utf-8'))
+        self._term_offsets = sections[1].cast('I')
+        self._terms = sections[2]
+        self._posting_offsets = sections[3].cast('I')
+        self._postings = sections[4]
+        self._chunk_records = sections[5].cast('I')
+        self.strings = CompactStrings(sections[6].cast('I'), sections[7])
+        self.term_count = term_count
+        self.chunk_count = chunk_count
+
+    @staticmethod
+    def write(path: str, meta: Dict, keyword_index: Dict[str, List[int]], chunks: List[Dict]):
+        """
+        写出紧凑索引文件
+
+        Args:
+            path: 输出路径
+            meta: 元数据（手册摘要、结构、事实等），以JSON存放
+            keyword_index: 词项 -> 升序块序号
+            chunks: 内容块（只写入偏移、章节、小节和关键词，内容从手册全文按偏移切出）
+        """
+        terms = sorted(keyword_index, key=lambda term: term.encode('utf-8'))
+        term_offsets, term_blob = array('I', [0]), bytearray()
+        posting_offsets, posting_blob = array('I', [0]), bytearray()
+        for term in terms:
+            term_blob += term.encode('utf-8')
+            term_offsets.append(len(term_blob))
+            posting_blob += encode_postings(keyword_index[term])
+            posting_offsets.append(len(posting_blob))
+
+        string_ids: Dict[str, int] = {}
+        string_offsets, string_blob = array('I', [0]), bytearray()
+
+        def string_id(text: str) -> int:
+            if text not in string_ids:
+                string_ids[text] = len(string_ids)
+                string_blob.extend(text.encode('utf-8'))
+                string_offsets.append(len(string_blob))
+            return string_ids[text]
+
+        records = array('I')
+        for chunk in chunks:
+            records.extend((chunk["start"], chunk["end"], string_id(chunk.get("chapter", "")),
+                            string_id(chunk.get("section", "")), string_id('\x1f'.join(chunk["keywords"]))))
+
+        sections = [json.dumps(meta, ensure_ascii=False).encode('utf-8'), term_offsets.tobytes(), bytes(term_blob),
+                    posting_offsets.tobytes(), bytes(posting_blob), records.tobytes(),
+                    string_offsets.tobytes(), bytes(string_blob)]
+
+        spans = []
+        offset = COMPACT_INDEX_HEADER.size
+        for data in sections:
+            offset += -offset % 8
+            spans.extend((offset, len(data)))
+            offset += len(data)
+
+        with open(path, 'wb') as f:
+            f.write(COMPACT_INDEX_HEADER.pack(COMPACT_INDEX_MAGIC, sys.byteorder == 'big', COMPACT_INDEX_FORMAT,
+                                              len(terms), len(chunks), *spans))
+            for (start, _), data in zip(zip(spans[::2], spans[1::2]), sections):
+                f.write(b'\x00' * (start - f.tell()))
+                f.write(data)
+
+    def _term_at(self, i: int) -> bytes:
+        return bytes(self._terms[self._term_offsets[i]:self._term_offsets[i + 1]])
+
+    def _find(self, term: str) -> int:
+        """二分查找词项序号，不存在时返回-1"""
+        key = term.encode('utf-8')
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.term_count and self._term_at(lo) == key else -1
+
+    def __getitem__(self, term: str) -> List[int]:
+        i = self._find(term)
+        if i < 0:
+            raise KeyError(term)
+        return decode_postings(self._postings[self._posting_offsets[i]:self._posting_offsets[i + 1]])
+
+    def __contains__(self, term) -> bool:
+        return isinstance(term, str) and self._find(term) >= 0
+
+    def __iter__(self):
+        for i in range(self.term_count):
+            yield str(self._term_at(i), 'utf-8')
+
+    def __len__(self) -> int:
+        return self.term_count
+
+    def chunks(self, content: str) -> CompactChunks:
+        """内容块序列，块内容从手册全文按偏移切出"""
+        return CompactChunks(self._chunk_records, self.strings, content)
+
+
+@dataclass
+class TocNode:
+    """目录树节点，[start, end)为该节点（含全部子节点）在手册全文中的字符区间"""
+    kind: str  # root / chapter / appendix / section / subsection
+    number: str
+    title: str
+    level: int
+    start: int
+    end: int = 0
+    chapter: str = ""  # 所属章或附录的编号
+    first_chunk: int = 0  # [first_chunk, last_chunk)为与该区间重叠的内容块
+    last_chunk: int = 0
+    parent: Optional['TocNode'] = field(default=None, repr=False)
+    children: List['TocNode'] = field(default_factory=list, repr=False)
+
+    @property
+    def label(self) -> str:
+        return f"{self.number} {self.title}".strip()
+
+
+class TocTree:
+    """
+    目录树：建索引时由structure["toc"]一次构建
+
+    节点按起始偏移排序存放，偏移到节点的区间查找和按编号取节点都只需二分/字典查找；
+    每个节点记录覆盖的内容块区间，用于把检索范围限定在某章或某节的子树内。
+    """
+
+    def __init__(self, toc: List[Dict], content_length: int, chunk_starts: List[int]):
+        self.root = TocNode("root", "", "", 1, 0, content_length, first_chunk=0, last_chunk=len(chunk_starts))
+        self.nodes: List[TocNode] = []  # 按start升序
+        self.by_number: Dict[str, List[TocNode]] = defaultdict(list)
+
+        stack = [self.root]
+        for item in toc:
+            node = TocNode(item["type"], item["number"], item["title"], item["level"], item["start"],
+                           chapter=item.get("chapter", item["number"]))
+            while stack[-1].level >= node.level:
+                stack.pop().end = node.start
+            node.parent = stack[-1]
+            stack[-1].children.append(node)
+            stack.append(node)
+            self.nodes.append(node)
+            self.by_number[node.number].append(node)
+        for node in stack[1:]:
+            node.end = content_length
+
+        for node in self.nodes:
+            node.first_chunk = max(bisect.bisect_right(chunk_starts, node.start) - 1, 0)
+            node.last_chunk = bisect.bisect_left(chunk_starts, node.end)
+        self._starts = [node.start for node in self.nodes]
+
+    def node_at(self, offset: int) -> TocNode:
+        """包含offset的最深节点（二分找到起点不超过offset的最后一个节点，再沿父节点上溯）"""
+        i = bisect.bisect_right(self._starts, offset) - 1
+        node = self.nodes[i] if i >= 0 else self.root
+        while node is not self.root and not node.start <= offset < node.end:
+            node = node.parent
+        return node
+
+    def path(self, node: TocNode) -> str:
+        """从章到该节点的路径，如"第3章 物理特性 > 3.5 跑道端安全区" """
+        labels = []
+        while node is not self.root:
+            labels.append(node.label)
+            node = node.parent
+        return " > ".join(reversed(labels))
+
+    def find(self, ref: str) -> List[TocNode]:
+        """
+        按编号查找节点
+
+        Args:
+            ref: "第5章"、"5"（即第5章）、"附录1"、"3.5"，或带所属章限定的"附篇A 7.1"；
+                 不带限定的节编号优先取正文章节（"7.1"指第7章的7.1而非附篇A的7.1）
+        """
+        ref = ref.strip()
+        scope, _, number = ref.rpartition(' ')
+        if re.fullmatch(r'\d+', number) and not scope:
+            number = f"第{number}章"
+        nodes = self.by_number.get(number, [])
+        if scope:
+            return [node for node in nodes if node.chapter == re.sub(r'\s+', '', scope)]
+        main_body = [node for node in nodes if node.chapter == f"第{number.split('.')[0]}章"]
+        return main_body or nodes
+
+    def chunk_range(self, ref: str) -> Tuple[int, int]:
+        """ref子树覆盖的内容块区间[lo, hi)，同一编号有多个节点（同章内的不同版本）时取覆盖范围"""
+        nodes = self.find(ref)
+        if not nodes:
+            raise ValueError(f"目录中没有找到: {ref}")
+        return min(node.first_chunk for node in nodes), max(node.last_chunk for node in nodes)
+
+    def render(self, detailed: bool) -> List[str]:
+        """按层级缩进的目录行，detailed为False时省略子节"""
+        lines = []
+        for node in self.nodes:
+            if node.kind == "subsection" and not detailed:
+                continue
+            indent = "  " * (node.level - 2)
+            lines.append(f"{indent}{'  ' * min(node.level - 2, 2)}{node.label}")
+        return lines
+
+
+class IndexSnapshot:
+    """
+    手册索引快照：手册内容、结构、分块、倒排索引和事实表
+
+    构建完成后不再修改，多个线程可以不加锁地同时检索。重新加载手册时构建新快照整体替换，
+    进行中的查询继续使用各自持有的旧快照直到结束。
+    """
+
+    def __init__(self, manual_path: str, version: int, index_cache: Optional[str] = None, workers: int = 1,
+                 log: Callable[[str], None] = print_progress):
+        """
+        加载手册并构建结构、分块、关键词索引和事实表
 
         Args:
             manual_path: 手册文件路径
-            max_context_length: 最大上下文长度（tokens）
+            version: 索引版本号，每次重新加载加1
+            index_cache: 索引缓存文件路径，与手册内容一致时直接加载
+            workers: 构建索引时的并行进程数
+            log: 进度信息输出函数
         """
         self.manual_path = manual_path
-        self.max_context_length = max_context_length
+        self.version = version
+        self.index_cache = index_cache
+        self.workers = workers
+        self._log = log
+        self._figure_index: Optional[Dict] = None  # 图表索引，首次使用时构建
+        self._figure_lock = threading.Lock()
+
         self.content = self._load_manual()
-        self.structure = self._parse_structure()
-        self.chunked_content = self._chunk_content()
-        self.conversation_history: List[ConversationTurn] = []
-        self.keyword_index = self._build_keyword_index()
-        self.session_id = hashlib.md5(str(time.time()).encode()).hexdigest()[:8]
+        facts = self._load_index_cache()
+        if facts is None:
+            self.structure = self._parse_structure()
+            self.analyzer = self._build_analyzer()
+            self.chunked_content = self._chunk_content()
+            chunk_terms = self._analyze_chunks(self.chunked_content)
+            self.keyword_index = self._build_keyword_index(chunk_terms)
+            facts = self._extract_facts()
+        self.fact_table = FactTable(facts, self.analyzer)
+        self.expander = QueryExpander(self.structure, self.keyword_index, self.analyzer)
+        self.toc_tree = TocTree(self.structure["toc"], len(self.content),
+                                [chunk["start"] for chunk in self.chunked_content])
+        self.toc_renders: Dict[bool, str] = {}  # 详细程度 -> 渲染好的目录
+
+    def _manual_digest(self) -> str:
+        """手册内容摘要，用于校验索引缓存"""
+        return hashlib.md5(self.content.encode('utf-8')).hexdigest()
+
+    def _load_index_cache(self) -> Optional[List[RequirementFact]]:
+        """
+        从索引缓存（JSON或紧凑格式，按文件头自动识别）加载结构、分块和关键词索引
 
-        print(f"✓ 系统初始化完成")
-        print(f"✓ 加载章节: {len(self.structure['chapters'])}个")
-        print(f"✓ 内容块数: {len(self.chunked_content)}个")
-        print(f"✓ 索引关键词: {len(self.keyword_index)}个")
+        Returns:
+            缓存中的数值事实；缓存不存在或与手册不一致时返回None
+        """
+        if not self.index_cache or not os.path.exists(self.index_cache):
+            return None
+        try:
+            if is_compact_index(self.index_cache):
+                compact_index = CompactIndex(self.index_cache)
+                cache = compact_index.meta
+            else:
+                compact_index = None
+                with open(self.index_cache, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+        except (OSError, ValueError) as e:
+            self._log(f"⚠️ 索引缓存读取失败: {e}")
+            return None
+
+        if cache.get("format") != INDEX_CACHE_FORMAT or cache.get("manual_digest") != self._manual_digest():
+            self._log("⚠️ 索引缓存与手册内容不一致，重新构建索引")
+            return None
+
+        self.structure = cache["structure"]
+        self.analyzer = self._build_analyzer()
+        if compact_index is not None:
+            self.chunked_content = compact_index.chunks(self.content)
+            self.keyword_index = compact_index
+        else:
+            self.chunked_content = cache["chunks"]
+            self.keyword_index = cache["keyword_index"]
+        self._log(f"✓ 已加载索引缓存: {self.index_cache}")
+        return [RequirementFact(**fact) for fact in cache["facts"]]
+
+    def _cache_meta(self) -> Dict:
+        """两种缓存格式共用的元数据"""
+        return {
+            "format": INDEX_CACHE_FORMAT,
+            "manual_path": self.manual_path,
+            "manual_digest": self._manual_digest(),
+            "structure": self.structure,
+            "facts": [asdict(fact) for fact in self.fact_table.facts]
+        }
+
+    def save_index_cache(self, path: str, compact: bool = False) -> str:
+        """
+        将结构、分块、关键词索引和数值事实写入缓存文件
+
+        Args:
+            path: 缓存文件路径
+            compact: 是否写成可mmap打开的紧凑格式（否则为JSON）
+        """
+        if compact:
+            CompactIndex.write(path, self._cache_meta(), self.keyword_index, self.chunked_content)
+        else:
+            cache = self._cache_meta()
+            cache["chunks"] = list(self.chunked_content)
+            cache["keyword_index"] = dict(self.keyword_index)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False)
+        self._log(f"✓ 索引缓存已写入: {path}")
+        return path
 
     def _load_manual(self) -> str:
         """加载手册内容"""
         try:
             with open(self.manual_path, 'r', encoding='utf-8', errors='ignore') as f:
                 content = f.read()
-                print(f"✓ 已加载手册，长度: {len(content)} 字符")
+                self._log(f"✓ 已加载手册，长度: {len(content)} 字符")
                 return content
         except Exception as e:
-            print(f"✗ 加载手册失败: {e}")
+            self._log(f"✗ 加载手册失败: {e}")
             # 尝试其他编码
             try:
                 with open(self.manual_path, 'r', encoding='gbk', errors='ignore') as f:
                     content = f.read()
-                    print(f"✓ 已加载手册(GBK编码)，长度: {len(content)} 字符")
+                    self._log(f"✓ 已加载手册(GBK编码)，长度: {len(content)} 字符")
                     return content
             except:
                 return ""
@@ -88,17 +1307,22 @@ class EnhancedAttachment14ManualQA:
         structure = {
             "chapters": {},
             "sections": {},
-            "definitions": {},
+            "definitions": {},  # 缩写 -> "中文名称（英文全称）"
+            "abbreviations": {},  # 缩写 -> [英文全称, 中文名称]
             "tables": {},
             "figures": {},
+            "terms": {},  # 中文术语 -> 缩写，如 跑道端安全区 -> RESA
             "toc": []  # 目录条目
         }
 
-        # 提取所有标题结构
+        # 提取所有标题结构（start为标题行在全文中的字符偏移）
         lines = self.content.split('\n')
         current_chapter = None
+        line_start = 0
 
         for line in lines:
+            line_offset = line_start
+            line_start += len(line) + 1
             line = line.strip()
 
             # 提取章节
@@ -112,11 +1336,26 @@ class EnhancedAttachment14ManualQA:
                     "level": 2,
                     "type": "chapter",
                     "number": chapter_key,
-                    "title": chapter_title
+                    "title": chapter_title,
+                    "start": line_offset
                 })
                 current_chapter = chapter_key
                 continue
 
+            # 提取附录和附篇（其下的小节归属附录而非最后一章）
+            appendix_match = APPENDIX_HEADING_PATTERN.match(line)
+            if appendix_match:
+                appendix_key = re.sub(r'\s+', '', appendix_match.group(1))
+                structure["toc"].append({
+                    "level": 2,
+                    "type": "appendix",
+                    "number": appendix_key,
+                    "title": appendix_match.group(2).strip(),
+                    "start": line_offset
+                })
+                current_chapter = appendix_key
+                continue
+
             # 提取小节
             section_match = re.match(r'^###\s*(\d+\.\d+(?:\.\d+)*)\s*(.+)$', line)
             if section_match and current_chapter:
@@ -129,11 +1368,12 @@ class EnhancedAttachment14ManualQA:
                     "number": section_num
                 }
                 structure["toc"].append({
-                    "level": 3,
+                    "level": 2 + section_num.count('.'),  # 按编号层级，如3.1为3级、3.1.7为4级
                     "type": "section",
                     "chapter": current_chapter,
                     "number": section_num,
-                    "title": section_title
+                    "title": section_title,
+                    "start": line_offset
                 })
                 continue
 
@@ -143,26 +1383,43 @@ class EnhancedAttachment14ManualQA:
                 subsection_num = subsection_match.group(1)
                 subsection_title = subsection_match.group(2).strip()
                 structure["toc"].append({
-                    "level": 4,
+                    "level": 2 + subsection_num.count('.'),
                     "type": "subsection",
                     "chapter": current_chapter,
                     "number": subsection_num,
-                    "title": subsection_title
+                    "title": subsection_title,
+                    "start": line_offset
                 })
 
-        # 提取定义（缩写和符号部分）
-        def_pattern = r'([A-Za-z][A-Za-z0-9\s\-/]+?)\s*[—–\-]\s*(.+?)(?=\n|$)'
-        def_sections = re.finditer(r'##\s*.*?(?:缩写|符号|定义).*?\n(.*?)(?=\n##|$)',
-                                   self.content, re.DOTALL | re.IGNORECASE)
-
-        for match in def_sections:
-            def_text = match.group(1)
-            definitions = re.findall(def_pattern, def_text)
-            for key, value in definitions:
-                key_clean = key.strip()
-                value_clean = value.strip()
-                if len(key_clean) > 1 and len(value_clean) > 3:
-                    structure["definitions"][key_clean] = value_clean
+        # 提取缩写表：先逐行列出"缩写 英文全称"，再列符号，最后按同样顺序列出各缩写和符号的中文名称
+        abbreviations = []  # [(缩写, 英文全称)]
+        chinese_names = []
+        abbr_section = re.search(r'^##\s*缩写和符号.*?\n(.*?)(?=^##\s)', self.content, re.DOTALL | re.MULTILINE)
+        part = None
+        for line in (abbr_section.group(1).split('\n') if abbr_section else []):
+            line = line.strip()
+            if line in ('缩写', '符号'):
+                part = line
+            elif part == '缩写':
+                match = re.match(r'^([A-Za-z][A-Za-z0-9/\-]*)\s*[†#]?\s*([A-Za-z].*)$', line)
+                if match:
+                    abbreviations.append((match.group(1), match.group(2).strip()))
+            elif part == '符号' and re.search(r'[\u4e00-\u9fa5]', line):
+                chinese_names.append(line)
+
+        if len(chinese_names) < len(abbreviations):  # 中文名称与缩写对不齐时只保留英文全称
+            chinese_names = []
+        for i, (abbr, english) in enumerate(abbreviations):
+            chinese = chinese_names[i] if chinese_names else ""
+            structure["abbreviations"][abbr] = [english, chinese]
+            structure["definitions"][abbr] = f"{chinese}（{english}）" if chinese else english
+            if chinese and re.fullmatch(r'[A-Z][A-Z0-9/\-]+', abbr):
+                structure["terms"].setdefault(chinese, abbr)
+
+        # 提取带缩写的术语定义，如"跑道端安全区（RESA）"
+        for match in re.finditer(r'^([\u4e00-\u9fa5]{2,12})\s*[（(]\s*([A-Z][A-Za-z0-9\-/]*)\s*[）)]',
+                                 self.content, re.MULTILINE):
+            structure["terms"].setdefault(match.group(1), match.group(2))
 
         # 提取表格和图片引用
         table_pattern = r'表\s*(\d+\.\d+(?:\.\d+)*)[\.\s]*([^。]+)'
@@ -181,31 +1438,35 @@ class EnhancedAttachment14ManualQA:
         return structure
 
     def _chunk_content(self, chunk_size: int = 2000) -> List[Dict]:
-        """将内容分块，便于检索"""
+        """将内容分块，便于检索（记录每块在全文中的字符区间）"""
         chunks = []
         lines = self.content.split('\n')
 
         current_chunk = []
         current_chapter = ""
         current_section = ""
+        chunk_start = 0  # 当前块在全文中的起始偏移
+        line_start = 0  # 当前行在全文中的起始偏移
 
         for line in lines:
-            # 检测章节标题
+            line_offset = line_start
+            line_start += len(line) + 1
+
+            # 检测章节和附录标题（块不跨章，每章的块是连续的一段）
             chapter_match = re.match(r'^##\s*第\s*([一二三四五六七八九十\d]+)\s*章\s*(.+)$', line)
-            if chapter_match:
+            appendix_match = APPENDIX_HEADING_PATTERN.match(line)
+            if chapter_match or appendix_match:
                 if current_chunk:
-                    chunks.append({
-                        "content": '\n'.join(current_chunk),
-                        "chapter": current_chapter,
-                        "section": current_section,
-                        "keywords": self._extract_keywords('\n'.join(current_chunk))
-                    })
+                    chunks.append(self._make_chunk(current_chunk, current_chapter, current_section, chunk_start))
                     current_chunk = []
 
-                chapter_num = chapter_match.group(1)
-                chapter_title = chapter_match.group(2).strip()
-                current_chapter = f"第{chapter_num}章 {chapter_title}"
+                if chapter_match:
+                    current_chapter = f"第{chapter_match.group(1)}章 {chapter_match.group(2).strip()}"
+                else:
+                    current_chapter = f"{re.sub(r'\s+', '', appendix_match.group(1))} {appendix_match.group(2).strip()}"
                 current_section = ""
+                if not current_chunk:
+                    chunk_start = line_offset
                 current_chunk.append(line)
                 continue
 
@@ -213,116 +1474,397 @@ class EnhancedAttachment14ManualQA:
             section_match = re.match(r'^###\s*(\d+\.\d+(?:\.\d+)*)\s*(.+)$', line)
             if section_match:
                 if current_chunk and len('\n'.join(current_chunk)) > 100:
-                    chunks.append({
-                        "content": '\n'.join(current_chunk),
-                        "chapter": current_chapter,
-                        "section": current_section,
-                        "keywords": self._extract_keywords('\n'.join(current_chunk))
-                    })
+                    chunks.append(self._make_chunk(current_chunk, current_chapter, current_section, chunk_start))
                     current_chunk = []
 
                 section_num = section_match.group(1)
                 section_title = section_match.group(2).strip()
                 current_section = f"{section_num} {section_title}"
+                if not current_chunk:
+                    chunk_start = line_offset
                 current_chunk.append(line)
                 continue
 
+            if not current_chunk:
+                chunk_start = line_offset
             current_chunk.append(line)
 
             # 如果当前块太大，分割
             if len('\n'.join(current_chunk)) > chunk_size:
-                chunks.append({
-                    "content": '\n'.join(current_chunk),
-                    "chapter": current_chapter,
-                    "section": current_section,
-                    "keywords": self._extract_keywords('\n'.join(current_chunk))
-                })
+                chunks.append(self._make_chunk(current_chunk, current_chapter, current_section, chunk_start))
                 current_chunk = []
 
         # 添加最后一个块
         if current_chunk:
-            chunks.append({
-                "content": '\n'.join(current_chunk),
-                "chapter": current_chapter,
-                "section": current_section,
-                "keywords": self._extract_keywords('\n'.join(current_chunk))
-            })
+            chunks.append(self._make_chunk(current_chunk, current_chapter, current_section, chunk_start))
 
         return chunks
 
-    def _build_keyword_index(self) -> Dict[str, List[int]]:
-        """构建关键词索引"""
-        index = defaultdict(list)
+    def _make_chunk(self, lines: List[str], chapter: str, section: str, start: int) -> Dict:
+        """由若干行构建内容块"""
+        content = '\n'.join(lines)
+        return {
+            "content": content,
+            "chapter": chapter,
+            "section": section,
+            "keywords": [],  # 由_analyze_chunks填充
+            "start": start,
+            "end": start + len(content)
+        }
+
+    def _build_analyzer(self) -> ChineseAnalyzer:
+        """用手册自身的标题和术语定义构建分词词典"""
+        words = [term for term in AIRPORT_TERMS if not term.isascii()]
 
-        for i, chunk in enumerate(self.chunked_content):
-            if "keywords" in chunk:
-                for keyword in chunk["keywords"]:
-                    index[keyword.lower()].append(i)
+        # 标题按非中文字符和连接虚字切开，如"跑道的宽度" -> 跑道、宽度
+        for item in self.structure["toc"]:
+            for fragment in re.split(r'[^\u4e00-\u9fa5]+|[的和与及或]', item["title"]):
+                if 2 <= len(fragment) <= HEADING_WORD_MAX_LENGTH:
+                    words.append(fragment)
+
+        words.extend(self.structure["terms"].keys())
+        return ChineseAnalyzer(words)
+
+    def _analyze_chunks(self, chunks: List[Dict]) -> List[List[str]]:
+        """提取各内容块的关键词（写入chunk["keywords"]），返回各块的索引词项；workers>1时多进程并行"""
+        texts = [chunk["content"] for chunk in chunks]
+        if self.workers > 1 and len(texts) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_analysis_worker,
+                                     initargs=(self.analyzer,)) as executor:
+                analyzed = list(executor.map(_analyze_chunk_in_worker, texts,
+                                             chunksize=max(1, len(texts) // (self.workers * 4))))
+        else:
+            analyzed = [analyze_chunk(text, self.analyzer) for text in texts]
+
+        chunk_terms = []
+        for chunk, (keywords, terms) in zip(chunks, analyzed):
+            chunk["keywords"] = keywords
+            chunk_terms.append(terms)
+        return chunk_terms
+
+    def _extract_facts(self) -> List[RequirementFact]:
+        """从各内容块中抽取数值要求"""
+        facts = []
+        for chunk_id, chunk in enumerate(self.chunked_content):
+            facts.extend(extract_requirement_facts(chunk, chunk_id))
+        return facts
+
+    def _build_keyword_index(self, chunk_terms: List[List[str]]) -> Dict[str, List[int]]:
+        """构建关键词索引（倒排表，块序号升序）"""
+        index = defaultdict(list)
 
-        # 添加缩写到索引
-        for abbr in self.structure["definitions"].keys():
-            index[abbr.lower()] = list(range(len(self.chunked_content)))  # 缩写在所有内容中搜索
+        for i, terms in enumerate(chunk_terms):
+            for term in terms:
+                index[term].append(i)
 
         return index
 
-    def _extract_keywords(self, text: str, max_keywords: int = 20) -> List[str]:
-        """从文本中提取关键词"""
-        keywords = set()
+    def extract_keywords(self, text: str, max_keywords: int = 20, min_freq: int = 2) -> List[str]:
+        """
+        从文本中提取关键词
+
+        Args:
+            text: 文本
+            max_keywords: 最多返回的关键词数
+            min_freq: 中文术语的最低出现次数（查询语句传1）
+        """
+        return extract_keywords(text, self.analyzer, max_keywords, min_freq)
+
+    def get_figure_index(self) -> Dict:
+        """获取图表索引（首次调用时加锁构建，之后直接读取）"""
+        figure_index = self._figure_index
+        if figure_index is None:
+            with self._figure_lock:
+                if self._figure_index is None:
+                    self._figure_index = self._build_figure_index()
+                figure_index = self._figure_index
+        return figure_index
+
+    @property
+    def figures_indexed(self) -> int:
+        """已构建的图表索引中的图片数，尚未构建时为0"""
+        figure_index = self._figure_index
+        return len(figure_index["figures"]) if figure_index else 0
+
+    def _build_figure_index(self, max_workers: int = 8) -> Dict:
+        """
+        构建图表索引：并行读取imgs/目录下图片的类型和尺寸，并关联引用位置所在的内容块和图标题
+
+        手册只以<img>引用image/chart裁剪图，表格以HTML <table>正文给出。table裁剪图的文件名只有
+        裁剪框、没有页码，无法与正文中的表格按顺序对应，因此不关联内容块，也不会随答案返回。
 
-        # 提取大写缩写
-        abbreviations = re.findall(r'\b[A-Z]{2,}[A-Z0-9/]*\b', text)
-        keywords.update(abbreviations)
+        Returns:
+            {"figures": {文件名: FigureInfo}, "by_chunk": {块序号: [文件名, ...]}, "index_version": 版本}
+        """
+        imgs_dir = os.path.join(os.path.dirname(self.manual_path), 'imgs')
+        figures: Dict[str, FigureInfo] = {}
+
+        if os.path.isdir(imgs_dir):
+            paths = [os.path.join(imgs_dir, name) for name in sorted(os.listdir(imgs_dir))]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for info in executor.map(load_figure_info, paths):
+                    if info:
+                        figures[info.file_name] = info
+
+        # 关联手册中的引用位置、内容块和标题（图x-y 在图片之后）
+        chunk_starts = [chunk["start"] for chunk in self.chunked_content]
+        caption_pattern = r'<div[^>]*>\s*([图表]\s*[A-Z]?\d*[\.\-－]\d+[^<]*)</div>'
+        by_chunk = defaultdict(list)
+
+        for match in re.finditer(r'<img\s+src="imgs/([^"]+)"', self.content):
+            info = figures.get(match.group(1))
+            if info is None or info.offset is not None:
+                continue
 
-        # 提取中文专业术语
-        chinese_terms = re.findall(r'[\u4e00-\u9fa5]{2,8}', text)
+            info.offset = match.start()
+            info.chunk_id = max(bisect.bisect_right(chunk_starts, info.offset) - 1, 0)
+            by_chunk[info.chunk_id].append(info.file_name)
 
-        # 过滤常见词
-        stop_words = {'可以', '一个', '进行', '需要', '要求', '如果', '应当', '必须', '不得'}
-        for term in chinese_terms:
-            if term not in stop_words and len(term) >= 2:
-                # 只保留出现频率较高的术语
-                if text.count(term) >= 2:
-                    keywords.add(term)
+            following = re.search(caption_pattern, self.content[match.end():match.end() + 300])
+            if following and following.group(1).startswith('图'):
+                info.caption = following.group(1).strip()
 
-        # 提取数字相关术语
-        number_refs = re.findall(r'(?:第[一二三四五六七八九十\d]+章|第\d+\.\d+条|表\d+\.\d+|图\d+\.\d+)', text)
-        keywords.update(number_refs)
+        return {"figures": figures, "by_chunk": dict(by_chunk), "index_version": self.version}
 
-        # 机场特定术语
-        airport_terms = ['跑道', '滑行道', '机坪', '航站楼', '灯光', '标志', '标记', '道面',
-                         '净空', '障碍物', 'ILS', 'VOR', 'NDB', 'PCN', 'ACN', 'RESA',
-                         '跑道端安全区', '升降带', '精密进近', '非精密进近']
 
-        for term in airport_terms:
-            if term in text:
-                keywords.add(term)
 
-        return list(keywords)[:max_keywords]
+class QASession:
+    """
+    单个用户的会话状态：对话历史、多轮prompt前缀和prompt用量
+
+    会话与索引快照分离，并发服务多个用户时每个用户各持有一个会话；同一会话的对话历史不应被多个线程同时写入。
+    """
+
+    def __init__(self, max_history: int = 10):
+        self.session_id = hashlib.md5(f"{time.time()}-{id(self)}".encode()).hexdigest()[:8]
+        self.max_history = max_history
+        self.conversation_history: List[ConversationTurn] = []
+        self.prompt_assembler = PromptAssembler()
+        self.prompt_usage = {"calls": 0, "prompt_tokens": 0, "estimated_prompt_tokens": 0,
+                             "cached_tokens": 0, "new_blocks": 0, "reused_blocks": 0}
+        self._usage_lock = threading.Lock()  # 批量问答时多个线程共用会话累计用量
+        self.scope: Optional[str] = None  # 检索范围（目录编号，如"第5章"、"3.5"），为空时检索全书
+
+    def add_turn(self, question: str, answer: str, references: List[Dict]):
+        """记录一轮对话，超过上限时丢弃最早的轮次"""
+        self.conversation_history.append(ConversationTurn(
+            question=question,
+            answer=answer,
+            references=references,
+            timestamp=time.time()
+        ))
+        if len(self.conversation_history) > self.max_history:
+            self.conversation_history = self.conversation_history[-self.max_history:]
+
+    def record_prompt_usage(self, prompt_usage: Dict):
+        """累计单次调用的prompt用量"""
+        with self._usage_lock:
+            self.prompt_usage["calls"] += 1
+            self.prompt_usage["prompt_tokens"] += prompt_usage["prompt_tokens"] or 0
+            self.prompt_usage["estimated_prompt_tokens"] += prompt_usage["estimated_prompt_tokens"]
+            self.prompt_usage["cached_tokens"] += prompt_usage["cached_tokens"]
+            self.prompt_usage["new_blocks"] += prompt_usage["new_blocks"]
+            self.prompt_usage["reused_blocks"] += prompt_usage["reused_blocks"]
+
+    def clear(self):
+        """清除对话历史和多轮prompt前缀"""
+        self.conversation_history = []
+        self.prompt_assembler.reset()
+
+    def show_history(self, max_turns: int = 5) -> str:
+        """显示对话历史"""
+        if not self.conversation_history:
+            return "暂无对话历史。"
+
+        history_lines = ["=" * 60]
+        history_lines.append("对话历史")
+        history_lines.append("=" * 60)
+
+        start_idx = max(0, len(self.conversation_history) - max_turns)
+
+        for i, turn in enumerate(self.conversation_history[start_idx:], start_idx + 1):
+            history_lines.append(f"\n[{i}] Q: {turn.question}")
+            history_lines.append(f"   A: {turn.answer[:150]}...")
+            history_lines.append(f"   时间: {time.strftime('%H:%M:%S', time.localtime(turn.timestamp))}")
+
+        return '\n'.join(history_lines)
+
+
+class EnhancedAttachment14ManualQA:
+    def __init__(self, manual_path: str, max_context_length: int = 32000, verbose: bool = True,
+                 index_cache: Optional[str] = None, workers: int = 1, max_prompt_tokens: int = 8000):
+        """
+        增强版附件14手册问答系统
+
+        Args:
+            manual_path: 手册文件路径
+            max_context_length: 最大上下文长度（tokens）
+            verbose: 是否输出进度信息
+            index_cache: 索引缓存文件路径，与手册内容一致时直接加载
+            workers: 构建索引时的并行进程数
+            max_prompt_tokens: 多轮对话单次请求的prompt预算（估算tokens），超出时重置会话前缀
+        """
+        self.manual_path = manual_path
+        self.max_context_length = max_context_length
+        # 多轮对话的prompt预算：超出后会话前缀重置；不超过上下文长度减去回答长度
+        self.max_prompt_tokens = min(max_prompt_tokens, max_context_length - ANSWER_MAX_TOKENS)
+        self.verbose = verbose
+        self.index_cache = index_cache
+        self.workers = workers
+        self.query_cache = QueryResultCache()
+        self.candidate_pool_size = 100  # 第一阶段召回的候选块数
+        self.fact_confidence_threshold = 0.9  # 事实表直接作答的最低置信度
+        self.last_search_timings: Dict = {}
+        self._reload_lock = threading.Lock()  # 只串行化重新加载，查询不加锁
+        self.snapshot = IndexSnapshot(manual_path, 1, index_cache, workers, self._log)
+        self.session = QASession()  # 默认会话（交互式问答）
+
+        self._log(f"✓ 系统初始化完成")
+        self._log(f"✓ 加载章节: {len(self.structure['chapters'])}个")
+        self._log(f"✓ 内容块数: {len(self.chunked_content)}个")
+        self._log(f"✓ 索引关键词: {len(self.keyword_index)}个")
+        self._log(f"✓ 数值事实: {len(self.fact_table)}条")
+
+    def _log(self, message: str):
+        """输出进度信息"""
+        if self.verbose:
+            print_progress(message)
+
+    # 当前快照和默认会话的只读视图，兼容原有的属性访问
+    @property
+    def index_version(self) -> int:
+        return self.snapshot.version
+
+    @property
+    def content(self) -> str:
+        return self.snapshot.content
+
+    @property
+    def structure(self) -> Dict:
+        return self.snapshot.structure
+
+    @property
+    def analyzer(self) -> ChineseAnalyzer:
+        return self.snapshot.analyzer
+
+    @property
+    def chunked_content(self) -> List[Dict]:
+        return self.snapshot.chunked_content
+
+    @property
+    def keyword_index(self) -> Dict[str, List[int]]:
+        return self.snapshot.keyword_index
+
+    @property
+    def fact_table(self) -> FactTable:
+        return self.snapshot.fact_table
+
+    @property
+    def session_id(self) -> str:
+        return self.session.session_id
+
+    @property
+    def conversation_history(self) -> List[ConversationTurn]:
+        return self.session.conversation_history
+
+    @property
+    def prompt_usage(self) -> Dict:
+        return self.session.prompt_usage
+
+    def new_session(self) -> QASession:
+        """创建一个独立会话，供并发服务的每个用户使用"""
+        return QASession()
+
+    def save_index_cache(self, path: Optional[str] = None, compact: bool = False) -> str:
+        """
+        将当前快照的结构、分块和关键词索引写入缓存文件
+
+        Args:
+            path: 缓存文件路径，为空时使用初始化时指定的路径
+            compact: 是否写成可mmap打开的紧凑格式
+        """
+        return self.snapshot.save_index_cache(path or self.index_cache, compact=compact)
+
+    def reload_manual(self, manual_path: Optional[str] = None):
+        """
+        重新加载手册（可切换到新文件）：在后台构建新快照后整体替换
+
+        进行中的查询继续使用旧快照，替换后开始的查询使用新快照；检索缓存随索引版本自动失效。
+
+        Args:
+            manual_path: 新的手册文件路径，为空时重新加载当前文件
+        """
+        with self._reload_lock:
+            manual_path = manual_path or self.manual_path
+            snapshot = IndexSnapshot(manual_path, self.snapshot.version + 1, self.index_cache, self.workers, self._log)
+            self.manual_path = manual_path
+            self.snapshot = snapshot  # 单次引用赋值，对并发读者是原子的
+        self._log(f"✓ 手册已重新加载，索引版本: {snapshot.version}")
+
+    def find_figures(self, query: str, search_results: List[SearchResult], max_figures: int = 3,
+                     snapshot: Optional[IndexSnapshot] = None) -> List[Dict]:
+        """
+        查找与检索结果关联的图表，标题与问题关键词重合多的优先
+
+        有标题与问题关键词重合的图表时只返回这些图表，都不重合时才退回检索结果所在块的全部图表。
+        嵌在更长关键词中的词（"跑道端安全区"中的"跑道"）不单独计入，避免只因同属跑道就返回无关的图。
+        """
+        snapshot = snapshot or self.snapshot
+        figure_index = snapshot.get_figure_index()
+        query_keywords = snapshot.extract_keywords(query, max_keywords=10, min_freq=1)
+        caption_keywords = [keyword for keyword in query_keywords
+                            if not any(keyword != other and keyword in other for other in query_keywords)]
+
+        candidates = []
+        for rank, result in enumerate(search_results):
+            for file_name in figure_index["by_chunk"].get(result.chunk_id, []):
+                info = figure_index["figures"][file_name]
+                overlap = sum(1 for keyword in caption_keywords if keyword in info.caption)
+                candidates.append((-overlap, rank, info))
+
+        if any(overlap for overlap, _, _ in candidates):
+            candidates = [candidate for candidate in candidates if candidate[0]]
+        candidates.sort(key=lambda x: (x[0], x[1]))
+
+        figures = []
+        for _, _, info in candidates[:max_figures]:
+            chunk = snapshot.chunked_content[info.chunk_id]
+            figures.append({
+                "file": info.file_name,
+                "path": info.path,
+                "type": info.kind,
+                "caption": info.caption,
+                "width": info.width,
+                "height": info.height,
+                "chapter": chunk.get("chapter", ""),
+                "section": chunk.get("section", "")
+            })
+        return figures
 
     def get_table_of_contents(self, detailed: bool = True) -> str:
-        """获取目录"""
+        """获取目录（每个快照按详细程度各渲染一次）"""
+        snapshot = self.snapshot
+        rendered = snapshot.toc_renders.get(detailed)
+        if rendered is None:
+            rendered = snapshot.toc_renders[detailed] = self._render_table_of_contents(snapshot, detailed)
+        return rendered
+
+    def _render_table_of_contents(self, snapshot: IndexSnapshot, detailed: bool) -> str:
+        """渲染目录、缩写表和常用搜索关键词"""
+        structure = snapshot.structure
         toc_lines = ["=" * 80]
         toc_lines.append("附件14第I卷（机场设计与运行）目录")
         toc_lines.append("=" * 80)
-
-        for item in self.structure["toc"]:
-            indent = "  " * (item["level"] - 2)
-
-            if item["type"] == "chapter":
-                toc_lines.append(f"{indent}{item['number']} {item['title']}")
-            elif item["type"] == "section":
-                toc_lines.append(f"{indent}  {item['number']} {item['title']}")
-            elif item["type"] == "subsection" and detailed:
-                toc_lines.append(f"{indent}    {item['number']} {item['title']}")
+        toc_lines.extend(snapshot.toc_tree.render(detailed))
 
         # 添加定义部分
-        if self.structure["definitions"]:
+        if structure["definitions"]:
             toc_lines.append("\n缩写和符号表:")
-            definitions_list = list(self.structure["definitions"].items())[:15]
+            definitions_list = list(structure["definitions"].items())[:15]
             for abbr, meaning in definitions_list:
                 toc_lines.append(f"  {abbr} — {meaning}")
-            if len(self.structure["definitions"]) > 15:
-                toc_lines.append(f"  ... 还有{len(self.structure["definitions"]) - 15}个定义")
+            if len(structure["definitions"]) > 15:
+                toc_lines.append(f"  ... 还有{len(structure["definitions"]) - 15}个定义")
 
         # 添加常用搜索建议
         toc_lines.append("\n" + "-" * 80)
@@ -335,20 +1877,170 @@ class EnhancedAttachment14ManualQA:
 
         return '\n'.join(toc_lines)
 
-    def semantic_search(self, query: str, top_k: int = 5) -> List[SearchResult]:
-        """语义搜索相关段落"""
-        query_keywords = self._extract_keywords(query, max_keywords=10)
+    def semantic_search(self, query: str, top_k: int = 5, snapshot: Optional[IndexSnapshot] = None,
+                        scope: Optional[str] = None) -> List[SearchResult]:
+        """
+        语义搜索相关段落（两阶段：倒排表召回候选块，再对候选块精排）
 
-        # 计算相关性分数
+        Args:
+            query: 查询语句
+            top_k: 返回结果数
+            snapshot: 检索使用的索引快照，为空时使用当前快照
+            scope: 只在该目录条目（如"第5章"、"3.5"）的子树内检索，目录中不存在时抛出ValueError
+        """
+        snapshot = snapshot or self.snapshot
+        chunk_range = snapshot.toc_tree.chunk_range(scope) if scope else None
+        results, timings = self._search(snapshot, query, top_k, chunk_range)
+        self.last_search_timings = timings
+        return results
+
+    def _search(self, snapshot: IndexSnapshot, query: str, top_k: int,
+                chunk_range: Optional[Tuple[int, int]] = None) -> Tuple[List[SearchResult], Dict]:
+        """
+        在给定快照上检索，返回(结果, 各阶段耗时)；只读快照，可被多个线程同时调用
+
+        chunk_range为[lo, hi)时只召回该区间内的块（每章的块连续，章或节的子树对应一个区间）。
+        """
+        query_keywords = snapshot.extract_keywords(query, max_keywords=10, min_freq=1)
+        timings = {"cache_hit": False, "candidates": 0, "candidate_ms": 0.0, "rerank_ms": 0.0}
+
+        # 同义写法和纠正后的缩写一并参与召回
+        stage_start = time.perf_counter()
+        expansions, corrections = snapshot.expander.expand(query)
+        timings["expansion_us"] = (time.perf_counter() - stage_start) * 1e6
+        timings["expanded_terms"] = expansions
+        timings["corrections"] = corrections
+        query_keywords = list(dict.fromkeys(query_keywords + expansions))
+
+        # 按归一化的关键词集合和top_k查缓存，命中时跳过打分
+        cache_key = (frozenset(keyword.lower() for keyword in query_keywords), top_k, chunk_range)
+        ranked = self.query_cache.get(cache_key, snapshot.version)
+        if ranked is None:
+            stage_start = time.perf_counter()
+            candidates = self._generate_candidates(snapshot, query_keywords, self.candidate_pool_size, chunk_range)
+            timings["candidate_ms"] = (time.perf_counter() - stage_start) * 1000
+            timings["candidates"] = len(candidates)
+
+            stage_start = time.perf_counter()
+            ranked = self._rerank_candidates(snapshot, query_keywords, candidates)[:top_k]
+            timings["rerank_ms"] = (time.perf_counter() - stage_start) * 1000
+            self.query_cache.put(cache_key, snapshot.version, ranked)
+        else:
+            timings["cache_hit"] = True
+
+        # 构建结果
+        results = []
+        for idx, score in ranked:
+            chunk = snapshot.chunked_content[idx]
+            # 提取查询相关上下文
+            context = self._extract_relevant_context(snapshot, chunk["content"], query)
+
+            results.append(SearchResult(
+                content=context,
+                chapter=chunk.get("chapter", ""),
+                section=chunk.get("section", ""),
+                confidence=min(score / 100, 1.0),
+                keywords=snapshot.extract_keywords(context, max_keywords=5),
+                chunk_id=idx,
+                toc_path=snapshot.toc_tree.path(snapshot.toc_tree.node_at(chunk["start"]))
+            ))
+
+        return results, timings
+
+    def _generate_candidates(self, snapshot: IndexSnapshot, query_keywords: List[str], limit: int,
+                             chunk_range: Optional[Tuple[int, int]] = None) -> List[int]:
+        """
+        第一阶段：按倒排表做MaxScore召回，得到粗排前limit个候选块
+
+        粗排分数为命中查询词的IDF之和。倒排表按IDF上界从小到大排列，
+        当前limit名的门槛分数超过若干低权重词的上界之和后，这些词不再驱动候选，
+        只用于补分，并且补分途中已不可能进入前limit名时提前结束。
+        限定检索范围时先把每个倒排表二分截取到chunk_range内（IDF仍按全书计算）。
+        """
+        chunk_count = len(snapshot.chunked_content)
+        lo, hi = chunk_range or (0, chunk_count)
+        postings = []
+        for keyword in dict.fromkeys(keyword.lower() for keyword in query_keywords):
+            posting_list = snapshot.keyword_index.get(keyword)
+            if posting_list:
+                weight = math.log(1 + chunk_count / len(posting_list))
+                if chunk_range:
+                    posting_list = posting_list[bisect.bisect_left(posting_list, lo):
+                                                bisect.bisect_left(posting_list, hi)]
+                if posting_list:
+                    postings.append((weight, posting_list))
+
+        # 索引（或检索范围）中没有任何查询词时退回子串扫描
+        if not postings:
+            keywords_lower = [keyword.lower() for keyword in query_keywords]
+            matched = [i for i in range(lo, hi)
+                       if any(keyword in snapshot.chunked_content[i]["content"].lower() for keyword in keywords_lower)]
+            return matched[:limit]
+
+        postings.sort(key=lambda x: x[0])
+        weights = [weight for weight, _ in postings]
+        upper_bounds = [sum(weights[:i + 1]) for i in range(len(weights))]  # 前i+1个词的上界之和
+        pointers = [0] * len(postings)
+
+        heap: List[Tuple[float, int]] = []  # (粗排分数, -块序号) 小顶堆
+        threshold = 0.0
+        first_essential = 0  # postings[first_essential:] 为驱动候选的倒排表
+
+        while True:
+            # 取驱动倒排表中最小的当前块序号
+            doc = None
+            for i in range(first_essential, len(postings)):
+                posting_list = postings[i][1]
+                if pointers[i] < len(posting_list) and (doc is None or posting_list[pointers[i]] < doc):
+                    doc = posting_list[pointers[i]]
+            if doc is None:
+                break
+
+            score = 0.0
+            for i in range(first_essential, len(postings)):
+                posting_list = postings[i][1]
+                if pointers[i] < len(posting_list) and posting_list[pointers[i]] == doc:
+                    score += weights[i]
+                    pointers[i] += 1
+
+            # 非驱动倒排表只补分，上界不足以进入前limit名时提前结束
+            for i in range(first_essential - 1, -1, -1):
+                if len(heap) >= limit and score + upper_bounds[i] <= threshold:
+                    break
+                posting_list = postings[i][1]
+                pointers[i] = bisect.bisect_left(posting_list, doc, pointers[i])
+                if pointers[i] < len(posting_list) and posting_list[pointers[i]] == doc:
+                    score += weights[i]
+
+            if len(heap) < limit:
+                heapq.heappush(heap, (score, -doc))
+            elif score > heap[0][0]:
+                heapq.heapreplace(heap, (score, -doc))
+
+            if len(heap) >= limit:
+                threshold = heap[0][0]
+                while first_essential < len(postings) and upper_bounds[first_essential] <= threshold:
+                    first_essential += 1
+
+        return [-neg_doc for _, neg_doc in sorted(heap, reverse=True)]
+
+    def _rerank_candidates(self, snapshot: IndexSnapshot, query_keywords: List[str],
+                           candidates: List[int]) -> List[Tuple[int, float]]:
+        """第二阶段：对候选块精排，按分数降序返回(块序号, 分数)"""
         scores = []
-        for i, chunk in enumerate(self.chunked_content):
+        for i in candidates:
+            chunk = snapshot.chunked_content[i]
             score = 0
 
             # 关键词匹配
             chunk_text = chunk["content"].lower()
+            heading_text = '\n'.join(line for line in chunk_text.split('\n') if line.lstrip().startswith('#'))
+            matched_keywords = []
             for keyword in query_keywords:
                 keyword_lower = keyword.lower()
                 if keyword_lower in chunk_text:
+                    matched_keywords.append(keyword_lower)
+
                     # 计算TF
                     tf = chunk_text.count(keyword_lower) / len(chunk_text.split())
                     score += tf * 10
@@ -358,6 +2050,13 @@ class EnhancedAttachment14ManualQA:
                         score += 5
                     if chunk.get("chapter") and keyword_lower in chunk["chapter"].lower():
                         score += 3
+                    if keyword_lower in heading_text:
+                        score += 2
+
+            # 多个查询词在块内出现得越近，权重越高
+            if len(matched_keywords) > 1:
+                span = self._min_keyword_span(chunk_text, matched_keywords)
+                score += 4 * (len(matched_keywords) - 1) / (1 + span / 100)
 
             # 考虑章节的重要性
             if chunk.get("chapter") and any(term in chunk["chapter"] for term in ["定义", "术语", "总则"]):
@@ -368,28 +2067,36 @@ class EnhancedAttachment14ManualQA:
 
         # 按分数排序
         scores.sort(key=lambda x: x[1], reverse=True)
-
-        # 构建结果
-        results = []
-        for idx, score in scores[:top_k]:
-            chunk = self.chunked_content[idx]
-            # 提取查询相关上下文
-            context = self._extract_relevant_context(chunk["content"], query)
-
-            results.append(SearchResult(
-                content=context,
-                chapter=chunk.get("chapter", ""),
-                section=chunk.get("section", ""),
-                confidence=min(score / 100, 1.0),
-                keywords=self._extract_keywords(context, max_keywords=5)
-            ))
-
-        return results
-
-    def _extract_relevant_context(self, text: str, query: str, context_chars: int = 800) -> str:
+        return scores
+
+    @staticmethod
+    def _min_keyword_span(text: str, keywords: List[str]) -> int:
+        """包含全部关键词的最短文本窗口长度（字符数）"""
+        positions = sorted((match.start(), k) for k, keyword in enumerate(keywords)
+                           for match in re.finditer(re.escape(keyword), text))
+
+        best_span = len(text)
+        counts = defaultdict(int)
+        covered = 0
+        left = 0
+        for right, (position, k) in enumerate(positions):
+            counts[k] += 1
+            if counts[k] == 1:
+                covered += 1
+            while covered == len(keywords):
+                left_position, left_k = positions[left]
+                best_span = min(best_span, position - left_position)
+                counts[left_k] -= 1
+                if counts[left_k] == 0:
+                    covered -= 1
+                left += 1
+        return best_span
+
+    def _extract_relevant_context(self, snapshot: IndexSnapshot, text: str, query: str,
+                                  context_chars: int = 800) -> str:
         """提取最相关的上下文片段"""
         # 找到关键词最密集的区域
-        query_keywords = self._extract_keywords(query, max_keywords=10)
+        query_keywords = snapshot.extract_keywords(query, max_keywords=10, min_freq=1)
 
         lines = text.split('\n')
         best_start = 0
@@ -418,31 +2125,16 @@ class EnhancedAttachment14ManualQA:
 
         return '\n'.join(context_lines)
 
-    def generate_search_suggestions(self, question: str) -> List[str]:
+    def generate_search_suggestions(self, question: str, snapshot: Optional[IndexSnapshot] = None) -> List[str]:
         """生成搜索建议"""
-        keywords = self._extract_keywords(question, max_keywords=10)
-        suggestions = []
-
-        # 基于关键词的章节建议
-        keyword_to_chapter = {
-            '跑道': ['第3章 物理特性', '第5章 目视助航设施'],
-            '滑行道': ['第3章 物理特性', '第5章 目视助航设施'],
-            '灯光': ['第5章 目视助航设施'],
-            '标志': ['第5章 目视助航设施'],
-            '障碍物': ['第4章 障碍物的限制和移除'],
-            '净空': ['第4章 障碍物的限制和移除'],
-            'PCN': ['第2章 机场数据', '附录1'],
-            'ACN': ['第2章 机场数据', '附录1'],
-            'ILS': ['第5章 目视助航设施', '附录'],
-            '精密进近': ['第5章 目视助航设施', '附录'],
-        }
+        snapshot = snapshot or self.snapshot
+        keywords = snapshot.extract_keywords(question, max_keywords=10, min_freq=1)
 
-        for keyword in keywords:
-            if keyword in keyword_to_chapter:
-                suggestions.extend(keyword_to_chapter[keyword])
-
-        # 去重
-        suggestions = list(dict.fromkeys(suggestions))
+        # 按关键词及其同义写法命中的目录条目给出建议
+        expansions, _ = snapshot.expander.expand(question)
+        if expansions:
+            keywords += snapshot.extract_keywords(' '.join(expansions), min_freq=1)
+        suggestions = snapshot.expander.suggest_headings(keywords)
 
         # 如果没有具体建议，给出一般性建议
         if not suggestions:
@@ -455,51 +2147,82 @@ class EnhancedAttachment14ManualQA:
 
         return suggestions[:5]
 
-    def ask_question(self, question: str, use_ai: bool = True) -> Dict:
+    def ask_question(self, question: str, use_ai: bool = True, use_history: bool = True,
+                     session: Optional[QASession] = None, scope: Optional[str] = None) -> Dict:
         """
         回答问题（支持多轮对话）
 
         Args:
             question: 用户问题
             use_ai: 是否使用AI生成答案
+            use_history: 是否结合并记录对话历史（批量问答时关闭）
+            session: 会话状态，为空时使用默认会话；并发服务多个用户时每个用户传入各自的会话
+            scope: 检索范围（目录编号，如"第5章"），为空时使用会话设定的范围
 
         Returns:
             包含答案和参考信息的字典
         """
         start_time = time.time()
-
-        print(f"\n🔍 正在搜索: '{question}'")
-
-        # 1. 语义搜索
-        search_results = self.semantic_search(question, top_k=5)
+        snapshot = self.snapshot  # 整个查询使用同一快照，重新加载不影响进行中的查询
+        session = session or self.session
+        scope = scope or session.scope
+        chunk_range = snapshot.toc_tree.chunk_range(scope) if scope else None
+
+        self._log(f"\n🔍 正在搜索: '{question}'" + (f"（范围: {scope}）" if scope else ""))
+
+        # 1. 数值类问题先查事实表，高置信度命中时直接作答
+        facts, fact_confidence = snapshot.fact_table.lookup(question)
+        if chunk_range:
+            facts = [fact for fact in facts if chunk_range[0] <= fact.chunk_id < chunk_range[1]]
+        use_facts = bool(facts) and fact_confidence >= self.fact_confidence_threshold
+
+        # 2. 语义搜索（事实表命中时以事实所在段落作为检索结果）
+        if use_facts:
+            search_results = self._fact_search_results(snapshot, facts, fact_confidence)
+            search_timings = {}
+        else:
+            search_results, search_timings = self._search(snapshot, question, 5, chunk_range)
+            self.last_search_timings = search_timings
         search_time = time.time() - start_time
-        print(f"✓ 搜索完成，找到 {len(search_results)} 个相关段落，耗时: {search_time:.2f}秒")
-
-        # 2. 生成搜索建议
-        suggestions = self.generate_search_suggestions(question)
+        self._log(f"✓ 搜索完成，找到 {len(search_results)} 个相关段落，耗时: {search_time:.2f}秒")
 
-        # 3. 准备上下文
-        context = self._prepare_context(question, search_results)
+        # 3. 生成搜索建议
+        suggestions = self.generate_search_suggestions(question, snapshot)
 
         # 4. 生成答案
-        if use_ai and search_results:
-            print("🤖 正在生成AI答案...")
-            answer, confidence = self._generate_ai_answer_with_context(question, context, search_results)
+        prompt_usage = None
+        if use_facts:
+            self._log(f"📐 事实表命中（置信度 {fact_confidence:.2f}），直接作答")
+            answer = self._generate_fact_answer(facts)
+            confidence = fact_confidence
+            answer_source = "fact_table"
+        elif use_ai and search_results:
+            self._log("🤖 正在生成AI答案...")
+            answer, confidence, prompt_usage = self._generate_ai_answer_with_context(
+                snapshot, session, question, search_results, use_history=use_history)
+            answer_source = "llm"
         else:
-            print("📝 生成基于检索的答案...")
-            answer = self._generate_retrieval_answer(question, search_results)
+            self._log("📝 生成基于检索的答案...")
+            answer = self._generate_retrieval_answer(snapshot, question, search_results)
             confidence = 0.7 if search_results else 0.3
+            answer_source = "retrieval"
 
         # 5. 构建响应
         response = {
             "question": question,
             "answer": answer,
             "confidence": confidence,
+            "answer_source": answer_source,
+            "scope": scope,
             "references": [],
             "search_suggestions": suggestions,
-            "related_keywords": self._extract_keywords(question, max_keywords=8),
+            "related_keywords": snapshot.extract_keywords(question, max_keywords=8, min_freq=1),
             "search_time": search_time,
-            "sources": []
+            "search_timings": search_timings,
+            "prompt_usage": prompt_usage,
+            "sources": [],
+            "figures": self.find_figures(question, search_results, snapshot=snapshot),
+            "index_version": snapshot.version
         }
 
         # 6. 添加引用来源
@@ -510,7 +2233,8 @@ class EnhancedAttachment14ManualQA:
                     "chapter": result.chapter,
                     "section": result.section,
                     "confidence": result.confidence,
-                    "keywords": result.keywords
+                    "keywords": result.keywords,
+                    "toc_path": result.toc_path
                 })
 
                 # 添加到源列表
@@ -522,94 +2246,99 @@ class EnhancedAttachment14ManualQA:
                 })
 
         # 7. 记录对话历史
-        conversation_turn = ConversationTurn(
-            question=question,
-            answer=answer,
-            references=response["references"],
-            timestamp=time.time()
-        )
-        self.conversation_history.append(conversation_turn)
-
-        # 限制历史长度
-        if len(self.conversation_history) > 10:
-            self.conversation_history = self.conversation_history[-10:]
+        if use_history:
+            session.add_turn(question, answer, response["references"])
 
         return response
 
-    def _prepare_context(self, question: str, search_results: List[SearchResult], max_tokens: int = 30000) -> str:
-        """准备上下文信息"""
-        context_parts = []
-
-        # 添加会话历史（最近3轮）
-        if len(self.conversation_history) > 1:
-            context_parts.append("之前的对话:")
-            for i, turn in enumerate(self.conversation_history[-3:-1]):
-                context_parts.append(f"用户: {turn.question}")
-                context_parts.append(f"系统: {turn.answer[:200]}...")
-            context_parts.append("")
+    def _fact_search_results(self, snapshot: IndexSnapshot, facts: List[RequirementFact],
+                             confidence: float) -> List[SearchResult]:
+        """把命中的事实转换为检索结果，供引用来源和图表查找使用"""
+        results = []
+        for chunk_id in dict.fromkeys(fact.chunk_id for fact in facts):
+            chunk = snapshot.chunked_content[chunk_id]
+            sentences = dict.fromkeys(fact.sentence for fact in facts if fact.chunk_id == chunk_id)
+            offset = chunk["start"] + max(chunk["content"].find(next(iter(sentences))), 0)  # 事实所在句的位置
+            results.append(SearchResult(
+                content="\n".join(sentences),
+                chapter=chunk["chapter"],
+                section=chunk["section"],
+                confidence=confidence,
+                keywords=chunk["keywords"],
+                chunk_id=chunk_id,
+                toc_path=snapshot.toc_tree.path(snapshot.toc_tree.node_at(offset))
+            ))
+        return results
 
-        # 添加相关搜索结果
-        context_parts.append("相关手册内容:")
+    def _generate_fact_answer(self, facts: List[RequirementFact]) -> str:
+        """根据事实表中的数值要求生成答案"""
+        first = facts[0]
+        location = first.section or first.chapter
+        if len(facts) == 1 and not first.condition:
+            return f"根据{location}：{first.subject}{first.comparator}{first.value_text()}。"
+
+        lines = [f"根据{location}，{first.subject}要求如下："]
+        for fact in facts:
+            condition = fact.condition or "一般情况"
+            lines.append(f"• {condition}：{fact.comparator}{fact.value_text()}")
+        return "\n".join(lines)
+
+    def _prepare_context(self, snapshot: IndexSnapshot, question: str, search_results: List[SearchResult],
+                         max_tokens: int = 30000) -> Tuple[List[Tuple[int, str]], List[str]]:
+        """
+        准备上下文信息
 
-        used_content = set()
+        Returns:
+            ([(块序号, 带来源的问题相关片段), ...], 相关定义)。只发送检索给出的片段而不是完整内容块，
+            多轮对话中相同片段仍按块序号复用。
+        """
+        blocks = []
         total_length = 0
 
         for result in search_results:
-            if result.confidence > 0.2:  # 只添加置信度较高的结果
-                content_hash = hash(result.content[:500])
-                if content_hash not in used_content:
-                    content_with_ref = f"[来源: {result.chapter}, {result.section}]\n{result.content}\n"
+            if result.confidence > 0.2 and result.chunk_id is not None:  # 只添加置信度较高的结果
+                content_with_ref = f"[来源: {result.chapter}, {result.section}]\n{result.content}"
+                if (result.chunk_id, content_with_ref) in blocks:
+                    continue
 
-                    if total_length + len(content_with_ref) < max_tokens:
-                        context_parts.append(content_with_ref)
-                        total_length += len(content_with_ref)
-                        used_content.add(content_hash)
+                if total_length + len(content_with_ref) < max_tokens:
+                    blocks.append((result.chunk_id, content_with_ref))
+                    total_length += len(content_with_ref)
 
         # 添加相关定义
-        context_parts.append("\n相关定义:")
-        question_keywords = self._extract_keywords(question)
+        definitions = []
+        question_keywords = snapshot.extract_keywords(question, min_freq=1)
         for keyword in question_keywords[:5]:
-            definition = self.get_definition(keyword)
+            definition = self.get_definition(keyword, snapshot)
             if definition:
-                context_parts.append(f"{keyword}: {definition}")
+                definitions.append(f"{keyword}: {definition}")
 
-        return '\n'.join(context_parts)
+        return blocks, definitions
 
-    def _generate_ai_answer_with_context(self, question: str, context: str, search_results: List[SearchResult]) -> \
-    Tuple[str, float]:
-        """使用AI生成答案（带上下文）"""
+    def _generate_ai_answer_with_context(self, snapshot: IndexSnapshot, session: QASession, question: str,
+                                         search_results: List[SearchResult],
+                                         use_history: bool = True) -> Tuple[str, float, Optional[Dict]]:
+        """使用AI生成答案（带上下文），返回(答案, 置信度, 本次prompt用量)"""
+        # 不使用历史时用一次性的组装器，不影响会话的多轮前缀
+        assembler = session.prompt_assembler if use_history else PromptAssembler()
         try:
             # 构建prompt
-            prompt = f"""你是一名国际民航组织附件14（机场设计与运行）的专家。基于以下手册内容回答问题。
-
-{context}
-
-当前问题：{question}
-
-请按以下要求回答：
-1. 提供专业、准确的回答，直接针对问题
-2. 引用具体来源（章节号、小节号）
-3. 如果信息不完整，基于相关知识给出可能的答案，并说明不确定性
-4. 回答要具体，避免模糊表述
-5. 对于操作性问题，给出具体步骤或标准
-6. 如果相关，提及相关表格或图表
-
-专业回答："""
+            blocks, definitions = self._prepare_context(snapshot, question, search_results)
+            messages, block_stats = assembler.build(question, blocks, definitions, snapshot.version,
+                                                    self.max_prompt_tokens)
 
             # 调用API
             response = client.chat.completions.create(
                 model="Qwen/Qwen2.5-72B-Instruct",
-                messages=[
-                    {"role": "system",
-                     "content": "你是国际民航组织附件14（机场设计与运行）专家，专门为机场工作人员提供专业指导。用中文回答，保持专业但易懂。"},
-                    {"role": "user", "content": prompt}
-                ],
+                messages=messages,
                 temperature=0.3,
-                max_tokens=2000,
+                max_tokens=ANSWER_MAX_TOKENS,
                 top_p=0.9
             )
 
             answer = response.choices[0].message.content
+            assembler.commit(messages, answer, block_stats)
+            prompt_usage = self._record_prompt_usage(session, messages, response, block_stats)
 
             # 计算置信度（基于搜索结果的平均置信度）
             if search_results:
@@ -622,15 +2351,33 @@ class EnhancedAttachment14ManualQA:
             if any(indicator in answer for indicator in uncertainty_indicators):
                 avg_confidence *= 0.7
 
-            return answer, min(avg_confidence, 0.95)
+            return answer, min(avg_confidence, 0.95), prompt_usage
 
         except Exception as e:
-            print(f"⚠️ AI生成失败: {e}")
+            self._log(f"⚠️ AI生成失败: {e}")
+            # 失败的请求可能就是前缀过长所致，重置后下一轮从完整前缀重新开始
+            assembler.reset()
             # 回退到检索答案
-            backup_answer = self._generate_retrieval_answer(question, search_results)
-            return backup_answer, 0.5
+            backup_answer = self._generate_retrieval_answer(snapshot, question, search_results)
+            return backup_answer, 0.5, None
+
+    def _record_prompt_usage(self, session: QASession, messages: List[Dict], response: Any,
+                             block_stats: Dict) -> Dict:
+        """记录单次调用的prompt token用量（优先使用接口返回的usage，否则估算）"""
+        usage = getattr(response, "usage", None)
+        details = getattr(usage, "prompt_tokens_details", None)
+        prompt_usage = {
+            "prompt_tokens": getattr(usage, "prompt_tokens", None),
+            "cached_tokens": getattr(details, "cached_tokens", None) or 0,
+            "estimated_prompt_tokens": sum(estimate_tokens(message["content"]) for message in messages),
+            "new_blocks": len(block_stats["new_blocks"]),
+            "reused_blocks": len(block_stats["reused_blocks"])
+        }
+        session.record_prompt_usage(prompt_usage)
+        return prompt_usage
 
-    def _generate_retrieval_answer(self, question: str, search_results: List[SearchResult]) -> str:
+    def _generate_retrieval_answer(self, snapshot: IndexSnapshot, question: str,
+                                   search_results: List[SearchResult]) -> str:
         """基于检索结果生成答案"""
         if not search_results:
             return "在手册中没有找到直接相关的内容。建议：\n1. 查看第3章 '物理特性' 和第5章 '目视助航设施'\n2. 尝试使用更具体的术语，如 '跑道宽度' 而非 '跑道'\n3. 查看缩写表获取术语定义"
@@ -639,11 +2386,11 @@ class EnhancedAttachment14ManualQA:
         answer_parts = ["基于附件14手册，相关信息如下：\n"]
 
         # 添加定义
-        question_keywords = self._extract_keywords(question)
+        question_keywords = snapshot.extract_keywords(question, min_freq=1)
         definitions_found = []
 
         for keyword in question_keywords[:3]:
-            definition = self.get_definition(keyword)
+            definition = self.get_definition(keyword, snapshot)
             if definition:
                 definitions_found.append(f"• {keyword}: {definition}")
 
@@ -675,56 +2422,67 @@ class EnhancedAttachment14ManualQA:
 
         return '\n'.join(answer_parts)
 
-    def get_definition(self, term: str) -> Optional[str]:
-        """获取术语定义"""
+    def get_section_text(self, ref: str) -> Optional[str]:
+        """
+        按目录编号取章节全文（含全部子节），同一编号有多个条目（如不同生效日期的版本）时依次拼接
+
+        Args:
+            ref: "第5章"、"附录1"、"3.5"，或带所属章限定的"附篇A 7.1"
+        """
+        snapshot = self.snapshot
+        nodes = snapshot.toc_tree.find(ref)
+        if not nodes:
+            return None
+        return '\n\n'.join(snapshot.content[node.start:node.end].strip() for node in nodes)
+
+    def get_definition(self, term: str, snapshot: Optional[IndexSnapshot] = None) -> Optional[str]:
+        """获取缩写定义，支持大小写不同的缩写和中文名称"""
+        structure = (snapshot or self.snapshot).structure
         term_clean = term.strip()
 
         # 直接查找
-        if term_clean in self.structure["definitions"]:
-            return self.structure["definitions"][term_clean]
+        if term_clean in structure["definitions"]:
+            return structure["definitions"][term_clean]
 
-        # 尝试查找近似
-        for key, value in self.structure["definitions"].items():
-            if term_clean.upper() == key.upper() or term_clean in value:
+        # 忽略大小写的缩写
+        for key, value in structure["definitions"].items():
+            if term_clean.upper() == key.upper():
                 return f"{key}: {value}"
 
-        # 尝试部分匹配
-        for key, value in self.structure["definitions"].items():
-            if term_clean.upper() in key.upper() or key.upper() in term_clean.upper():
-                return f"{key}: {value}"
+        # 中文名称对应的缩写
+        abbr = structure["terms"].get(term_clean)
+        if abbr in structure["definitions"]:
+            return f"{abbr}: {structure['definitions'][abbr]}"
 
         return None
 
-    def show_conversation_history(self, max_turns: int = 5) -> str:
-        """显示对话历史"""
-        if not self.conversation_history:
-            return "暂无对话历史。"
-
-        history_lines = ["=" * 60]
-        history_lines.append("对话历史")
-        history_lines.append("=" * 60)
-
-        start_idx = max(0, len(self.conversation_history) - max_turns)
-
-        for i, turn in enumerate(self.conversation_history[start_idx:], start_idx + 1):
-            history_lines.append(f"\n[{i}] Q: {turn.question}")
-            history_lines.append(f"   A: {turn.answer[:150]}...")
-            history_lines.append(f"   时间: {time.strftime('%H:%M:%S', time.localtime(turn.timestamp))}")
+    def clear_history(self):
+        """清除默认会话的对话历史和多轮prompt前缀"""
+        self.session.clear()
 
-        return '\n'.join(history_lines)
+    def show_conversation_history(self, max_turns: int = 5) -> str:
+        """显示默认会话的对话历史"""
+        return self.session.show_history(max_turns)
 
     def get_system_status(self) -> Dict:
         """获取系统状态"""
+        snapshot = self.snapshot
         return {
-            "session_id": self.session_id,
-            "manual_loaded": len(self.content) > 0,
-            "content_length": len(self.content),
-            "chapters_count": len(self.structure["chapters"]),
-            "definitions_count": len(self.structure["definitions"]),
-            "conversation_turns": len(self.conversation_history),
-            "keyword_index_size": len(self.keyword_index),
-            "chunks_count": len(self.chunked_content),
-            "max_context_length": self.max_context_length
+            "session_id": self.session.session_id,
+            "manual_loaded": len(snapshot.content) > 0,
+            "content_length": len(snapshot.content),
+            "chapters_count": len(snapshot.structure["chapters"]),
+            "definitions_count": len(snapshot.structure["definitions"]),
+            "facts_count": len(snapshot.fact_table),
+            "conversation_turns": len(self.session.conversation_history),
+            "keyword_index_size": len(snapshot.keyword_index),
+            "chunks_count": len(snapshot.chunked_content),
+            "max_context_length": self.max_context_length,
+            "index_version": snapshot.version,
+            "figures_indexed": snapshot.figures_indexed,
+            "query_cache": self.query_cache.stats(),
+            "last_search_timings": self.last_search_timings,
+            "prompt_usage": dict(self.session.prompt_usage)
         }
 
 
@@ -743,6 +2501,21 @@ def display_answer(response: Dict):
 
     print(f"{confidence_emoji} 置信度: {response['confidence']:.1%}")
     print(f"⏱️ 搜索耗时: {response['search_time']:.2f}秒")
+    if response.get("scope"):
+        print(f"📑 检索范围: {response['scope']}")
+    if response.get("answer_source") == "fact_table":
+        print("📐 答案来源: 数值事实表（未调用大模型）")
+    if response.get("prompt_usage"):
+        usage = response["prompt_usage"]
+        tokens = usage["prompt_tokens"] or usage["estimated_prompt_tokens"]
+        print(f"🧾 Prompt: {tokens} tokens (新增内容块 {usage['new_blocks']} 个，复用 {usage['reused_blocks']} 个)")
+    timings = response.get("search_timings")
+    if timings and not timings.get("cache_hit"):
+        print(f"   召回: {timings['candidate_ms']:.1f}ms ({timings['candidates']}个候选) | 精排: {timings['rerank_ms']:.1f}ms")
+    if timings and timings.get("corrections"):
+        print("✏️ 纠正: " + ", ".join(f"{wrong} → {right}" for wrong, right in timings["corrections"].items()))
+    if timings and timings.get("expanded_terms"):
+        print(f"🔁 查询扩展: {' | '.join(timings['expanded_terms'])}")
 
     print("\n" + "-" * 80)
     print("💡 答案:")
@@ -756,11 +2529,24 @@ def display_answer(response: Dict):
         print("-" * 80)
         for i, ref in enumerate(response["references"][:3], 1):
             print(f"\n{i}. {ref['chapter']}")
-            if ref.get('section'):
+            if ref.get('toc_path'):
+                print(f"   目录位置: {ref['toc_path']}")
+            elif ref.get('section'):
                 print(f"   小节: {ref['section']}")
             print(f"   相关度: {ref['confidence']:.1%}")
             print(f"   内容摘要: {ref['content'][:200]}...")
 
+    # 显示相关图表
+    if response.get("figures"):
+        print("\n" + "-" * 80)
+        print("🖼️ 相关图表:")
+        print("-" * 80)
+        for i, figure in enumerate(response["figures"], 1):
+            caption = figure["caption"] or figure["file"]
+            print(f"{i}. {caption} ({figure['type']}, {figure['width']}x{figure['height']})")
+            print(f"   位置: {figure['chapter']} {figure['section']}")
+            print(f"   文件: {figure['path']}")
+
     # 显示关键词
     if response.get("related_keywords"):
         print("\n" + "-" * 80)
@@ -779,17 +2565,16 @@ def display_answer(response: Dict):
     print("\n" + "=" * 80)
 
 
-def main():
-    """主函数"""
-    # 设置文件路径
-    manual_path = r"D:\AlgorithmClub\Damoxingyuanli\homework\datas\附件14 机场  — 机场设计与运行_第I卷 (第九版，2022年7月)\index.md"
+def run_chat(args: argparse.Namespace):
+    """交互式问答"""
+    manual_path = args.manual
 
     print("🚀 正在初始化附件14手册问答系统...")
     print(f"📂 文件路径: {manual_path}")
 
     try:
         # 初始化系统
-        qa_system = EnhancedAttachment14ManualQA(manual_path)
+        qa_system = EnhancedAttachment14ManualQA(manual_path, index_cache=args.cache)
 
         # 显示系统状态
         status = qa_system.get_system_status()
@@ -809,21 +2594,8 @@ def main():
         print("\n" + "=" * 80)
         print("💡 示例问题（您可以直接输入数字选择）:")
         print("=" * 80)
-        example_questions = [
-            "1. 跑道端安全区(RESA)的尺寸要求是什么？",
-            "2. PCN和ACN分别代表什么？如何计算？",
-            "3. 跑道宽度和长度的基本要求是什么？",
-            "4. 目视进近坡度指示系统(VASIS)的布置要求？",
-            "5. 障碍物限制面包括哪些？各自的标准是什么？",
-            "6. 滑行道的最小宽度要求是多少？",
-            "7. 跑道标志和滑行道标志有什么区别？",
-            "8. 机场灯光系统有哪些类型？",
-            "9. 精密进近跑道和非精密进近跑道的区别？",
-            "10. 机场道面强度报告PCN如何解读？"
-        ]
-
-        for q in example_questions:
-            print(q)
+        for i, q in enumerate(EXAMPLE_QUESTIONS, 1):
+            print(f"{i}. {q}")
 
         print("\n" + "=" * 80)
         print("💬 开始对话 (输入 'help' 查看帮助, 'quit' 退出)")
@@ -850,7 +2622,10 @@ def main():
                     print("  history   - 显示对话历史")
                     print("  status    - 显示系统状态")
                     print("  keywords  - 显示常用关键词")
+                    print("  scope <编号> - 只在该章节内检索（如 scope 第5章），不带编号时恢复全书检索")
+                    print("  section <编号> - 显示该章节全文（如 section 3.5）")
                     print("  clear     - 清除对话历史")
+                    print("  reload    - 重新加载手册")
                     print("  quit      - 退出系统")
                     print("\n💡 提示：")
                     print("  • 输入数字1-10选择示例问题")
@@ -883,15 +2658,37 @@ def main():
                     print(" | ".join(keywords))
                     continue
 
+                elif user_input.lower() == 'scope' or user_input.lower().startswith('scope '):
+                    ref = user_input[len('scope'):].strip()
+                    if not ref:
+                        qa_system.session.scope = None
+                        print("📑 已恢复全书检索")
+                    elif qa_system.snapshot.toc_tree.find(ref):
+                        qa_system.session.scope = ref
+                        print(f"📑 检索范围: {ref}")
+                    else:
+                        print(f"❌ 目录中没有找到: {ref}")
+                    continue
+
+                elif user_input.lower().startswith('section '):
+                    ref = user_input[len('section'):].strip()
+                    text = qa_system.get_section_text(ref)
+                    print(text if text is not None else f"❌ 目录中没有找到: {ref}")
+                    continue
+
+                elif user_input.lower() == 'reload':
+                    qa_system.reload_manual()
+                    continue
+
                 elif user_input.lower() == 'clear':
-                    qa_system.conversation_history = []
+                    qa_system.clear_history()
                     print("🗑️ 对话历史已清除")
                     continue
 
                 # 处理数字选择示例问题
-                elif user_input.isdigit() and 1 <= int(user_input) <= len(example_questions):
+                elif user_input.isdigit() and 1 <= int(user_input) <= len(EXAMPLE_QUESTIONS):
                     idx = int(user_input) - 1
-                    actual_question = example_questions[idx].split('. ', 1)[1]
+                    actual_question = EXAMPLE_QUESTIONS[idx]
                     print(f"\n📝 选择问题: {actual_question}")
                     user_input = actual_question
 
@@ -917,5 +2714,365 @@ def main():
         print("请检查: 1) 文件路径 2) API密钥 3) 网络连接")
 
 
+def _print_json(data: Any):
+    print(json.dumps(data, ensure_ascii=False, indent=2))
+
+
+def _load_questions(path: Optional[str]) -> List[str]:
+    """读取问题文件（每行一个），未指定时使用示例问题"""
+    if not path:
+        return EXAMPLE_QUESTIONS
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def run_build_index(args: argparse.Namespace):
+    """离线构建索引并写入缓存"""
+    start_time = time.time()
+    qa_system = EnhancedAttachment14ManualQA(args.manual, verbose=args.verbose, workers=args.workers)
+    default_name = "index_cache.a14idx" if args.compact else "index_cache.json"
+    output = args.output or args.cache or os.path.join(os.path.dirname(args.manual), default_name)
+    qa_system.save_index_cache(output, compact=args.compact)
+    _print_json({
+        "cache": output,
+        "bytes": os.path.getsize(output),
+        "chunks": len(qa_system.chunked_content),
+        "keyword_index_size": len(qa_system.keyword_index),
+        "build_seconds": round(time.time() - start_time, 3)
+    })
+
+
+def run_search(args: argparse.Namespace):
+    """检索并以JSON输出结果"""
+    qa_system = EnhancedAttachment14ManualQA(args.manual, verbose=args.verbose, index_cache=args.cache)
+    try:
+        results = qa_system.semantic_search(args.query, top_k=args.top_k, scope=args.scope)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    _print_json({
+        "query": args.query,
+        "scope": args.scope,
+        "timings": qa_system.last_search_timings,
+        "results": [asdict(result) for result in results]
+    })
+
+
+def run_ask(args: argparse.Namespace):
+    """从标准输入逐行读取JSONL问题，按输入顺序向标准输出流式写出JSONL答案"""
+    qa_system = EnhancedAttachment14ManualQA(args.manual, verbose=args.verbose, index_cache=args.cache)
+
+    def answer(line_no: int, line: str) -> Dict:
+        try:
+            request = json.loads(line)
+            if isinstance(request, str):
+                request = {"question": request}
+            response = qa_system.ask_question(request["question"], use_ai=not args.no_ai, use_history=False,
+                                              scope=request.get("scope"))
+            response["id"] = request.get("id", line_no)
+            return response
+        except Exception as e:
+            return {"id": line_no, "error": str(e)}
+
+    # 同时在处理中的问题数有上限，内存占用不随输入规模增长
+    max_pending = max(1, args.workers * 2)
+    pending = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for line_no, line in enumerate(sys.stdin, 1):
+            line = line.strip()
+            if not line:
+                continue
+            pending.append(executor.submit(answer, line_no, line))
+            while len(pending) >= max_pending:
+                print(json.dumps(pending.pop(0).result(), ensure_ascii=False), flush=True)
+        for future in pending:
+            print(json.dumps(future.result(), ensure_ascii=False), flush=True)
+
+
+def run_section(args: argparse.Namespace):
+    """按目录编号输出章节全文"""
+    qa_system = EnhancedAttachment14ManualQA(args.manual, verbose=args.verbose, index_cache=args.cache)
+    nodes = qa_system.snapshot.toc_tree.find(args.ref)
+    if not nodes:
+        print(f"目录中没有找到: {args.ref}", file=sys.stderr)
+        sys.exit(1)
+    if not args.json:
+        print(qa_system.get_section_text(args.ref))
+        return
+    toc_tree = qa_system.snapshot.toc_tree
+    _print_json([{
+        "path": toc_tree.path(node),
+        "start": node.start,
+        "end": node.end,
+        "chunks": [node.first_chunk, node.last_chunk],
+        "text": qa_system.snapshot.content[node.start:node.end].strip()
+    } for node in nodes])
+
+
+def run_bench(args: argparse.Namespace):
+    """检索性能基准：初始化耗时、冷/热查询延迟和缓存命中情况"""
+    start_time = time.time()
+    qa_system = EnhancedAttachment14ManualQA(args.manual, verbose=args.verbose, index_cache=args.cache)
+    init_seconds = time.time() - start_time
+
+    questions = _load_questions(args.questions)
+
+    def measure(rounds: int) -> Dict:
+        latencies = []
+        for _ in range(rounds):
+            for question in questions:
+                query_start = time.perf_counter()
+                qa_system.semantic_search(question, top_k=args.top_k)
+                latencies.append((time.perf_counter() - query_start) * 1000)
+        latencies.sort()
+        return {
+            "queries": len(latencies),
+            "mean_ms": round(sum(latencies) / len(latencies), 3),
+            "p50_ms": round(latencies[len(latencies) // 2], 3),
+            "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3)
+        }
+
+    cold = measure(1)
+    warm = measure(args.repeat)
+    _print_json({
+        "init_seconds": round(init_seconds, 3),
+        "chunks": len(qa_system.chunked_content),
+        "cold": cold,
+        "warm": warm,
+        "query_cache": qa_system.query_cache.stats()
+    })
+
+
+def run_check_facts(args: argparse.Namespace):
+    """事实表回归检查：逐个问题核对是否直接作答以及给出的数值，有不符时以状态码1退出"""
+    qa_system = EnhancedAttachment14ManualQA(args.manual, verbose=args.verbose, index_cache=args.cache)
+    fact_table = qa_system.snapshot.fact_table
+    report = []
+    for question, expected in FACT_CHECK_CASES:
+        facts, confidence = fact_table.lookup(question)
+        direct = bool(facts) and confidence >= qa_system.fact_confidence_threshold
+        values = [fact.value_text() for fact in facts] if direct else []
+        report.append({
+            "question": question,
+            "confidence": round(confidence, 3),
+            "direct_answer": direct,
+            "values": values,
+            "expected": expected,
+            "ok": expected in values if expected else not direct
+        })
+    _print_json(report)
+    if not all(case["ok"] for case in report):
+        sys.exit(1)
+
+
+def run_stress(args: argparse.Namespace):
+    """
+    并发压力测试：多个线程各持独立会话同时问答（不调用大模型），可在后台周期性重新加载手册
+
+    校验每个回答与单线程基线一致、各会话历史互不串扰，并报告不同线程数下的吞吐量。
+    """
+    qa_system = EnhancedAttachment14ManualQA(args.manual, verbose=args.verbose, index_cache=args.cache)
+    if args.no_cache:
+        qa_system.query_cache = QueryResultCache(max_entries=0)
+    questions = _load_questions(args.questions)
+
+    def signature(response: Dict) -> Tuple:
+        return response["answer"], tuple((ref["chapter"], ref["section"]) for ref in response["references"])
+
+    baseline = {question: signature(qa_system.ask_question(question, use_ai=False, use_history=False,
+                                                           session=qa_system.new_session()))
+                for question in questions}
+
+    def worker(offset: int, count: int) -> Dict:
+        session = qa_system.new_session()
+        asked = []
+        stats = {"mismatches": 0, "errors": 0, "versions": set()}
+        for i in range(count):
+            question = questions[(offset + i) % len(questions)]
+            try:
+                response = qa_system.ask_question(question, use_ai=False, session=session)
+            except Exception:
+                stats["errors"] += 1
+                continue
+            asked.append(question)
+            stats["versions"].add(response["index_version"])
+            if signature(response) != baseline[question]:
+                stats["mismatches"] += 1
+        history = [turn.question for turn in session.conversation_history]
+        stats["history_ok"] = history == asked[-session.max_history:]
+        return stats
+
+    def reloader(stop: threading.Event, reloads: List[int]):
+        while not stop.wait(args.reload_interval):
+            qa_system.reload_manual()
+            reloads.append(qa_system.index_version)
+
+    rounds = []
+    for threads in [int(n) for n in args.threads.split(',')]:
+        per_thread = max(1, args.queries // threads)
+        stop = threading.Event()
+        reloads: List[int] = []
+        reload_thread = None
+        if args.reload_interval > 0:
+            reload_thread = threading.Thread(target=reloader, args=(stop, reloads), daemon=True)
+            reload_thread.start()
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(worker, [t * 7 for t in range(threads)], [per_thread] * threads))
+        elapsed = time.perf_counter() - start_time
+
+        stop.set()
+        if reload_thread:
+            reload_thread.join()
+
+        queries = per_thread * threads
+        rounds.append({
+            "threads": threads,
+            "queries": queries,
+            "seconds": round(elapsed, 3),
+            "qps": round(queries / elapsed, 1),
+            "mismatches": sum(result["mismatches"] for result in results),
+            "errors": sum(result["errors"] for result in results),
+            "sessions_isolated": all(result["history_ok"] for result in results),
+            "index_versions_seen": sorted(set().union(*(result["versions"] for result in results))),
+            "reloads": len(reloads)
+        })
+
+    base_qps = rounds[0]["qps"]
+    for round_stats in rounds:
+        round_stats["speedup"] = round(round_stats["qps"] / base_qps, 2)
+    _print_json({
+        "questions": len(questions),
+        "query_cache": "disabled" if args.no_cache else qa_system.query_cache.stats(),
+        "rounds": rounds,
+        "passed": all(r["mismatches"] == 0 and r["errors"] == 0 and r["sessions_isolated"] for r in rounds)
+    })
+
+
+def run_bench_storage(args: argparse.Namespace):
+    """
+    索引存储基准：JSON缓存（载入为dict/list）与mmap紧凑索引对比
+
+    比较文件大小、加载耗时、加载后常驻的Python对象内存和查询耗时，并校验两者检索结果一致。
+    """
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix="a14_index_")
+    os.makedirs(output_dir, exist_ok=True)
+    builder = EnhancedAttachment14ManualQA(args.manual, verbose=args.verbose)
+    paths = {
+        "json": builder.save_index_cache(os.path.join(output_dir, "index_cache.json")),
+        "compact": builder.save_index_cache(os.path.join(output_dir, "index_cache.a14idx"), compact=True)
+    }
+    questions = _load_questions(args.questions)
+    expected = [[(result.chunk_id, result.confidence) for result in builder.semantic_search(question)]
+                for question in questions]
+
+    report = {}
+    for name, path in paths.items():
+        load_times = []
+        for _ in range(args.repeat):
+            load_start = time.perf_counter()
+            IndexSnapshot(args.manual, 1, path, log=lambda message: None)
+            load_times.append((time.perf_counter() - load_start) * 1000)
+
+        tracemalloc.start()
+        snapshot = IndexSnapshot(args.manual, 1, path, log=lambda message: None)
+        resident_bytes = tracemalloc.get_traced_memory()[0] - len(snapshot.content.encode('utf-8'))
+        tracemalloc.stop()
+
+        qa_system = EnhancedAttachment14ManualQA(args.manual, verbose=False, index_cache=path)
+        qa_system.query_cache = QueryResultCache(max_entries=0)
+        latencies = []
+        matches = True
+        for _ in range(args.repeat):
+            for question, want in zip(questions, expected):
+                query_start = time.perf_counter()
+                results = qa_system.semantic_search(question)
+                latencies.append((time.perf_counter() - query_start) * 1000)
+                matches &= [(result.chunk_id, result.confidence) for result in results] == want
+        latencies.sort()
+
+        report[name] = {
+            "path": path,
+            "file_bytes": os.path.getsize(path),
+            "load_ms_min": round(min(load_times), 3),
+            "load_ms_median": round(sorted(load_times)[len(load_times) // 2], 3),
+            "resident_python_bytes": resident_bytes,
+            "query_ms_mean": round(sum(latencies) / len(latencies), 3),
+            "query_ms_p50": round(latencies[len(latencies) // 2], 3),
+            "query_ms_p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+            "results_match_in_memory_build": matches
+        }
+
+    _print_json(report)
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    """命令行参数"""
+    parser = argparse.ArgumentParser(description="附件14手册智能问答系统")
+    parser.add_argument("--manual", default=DEFAULT_MANUAL_PATH, help="手册index.md路径")
+    parser.add_argument("--cache", default=None, help="索引缓存文件路径（由build-index生成）")
+    parser.add_argument("--verbose", action="store_true", help="输出初始化和检索进度信息")
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("chat", help="交互式问答（默认）")
+
+    build_parser = subparsers.add_parser("build-index", help="并行构建索引并写入缓存")
+    build_parser.add_argument("--output", default=None, help="缓存输出路径，默认写到手册所在目录")
+    build_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="并行进程数")
+    build_parser.add_argument("--compact", action="store_true", help="写成可mmap打开的紧凑索引格式")
+
+    search_parser = subparsers.add_parser("search", help="检索并输出JSON")
+    search_parser.add_argument("query", help="查询语句")
+    search_parser.add_argument("--top-k", type=int, default=5)
+    search_parser.add_argument("--scope", default=None, help="只在该章节内检索，如 第5章、附录1、3.5")
+
+    section_parser = subparsers.add_parser("section", help="按目录编号输出章节全文")
+    section_parser.add_argument("ref", help="目录编号，如 第5章、3.5、附篇A 7.1")
+    section_parser.add_argument("--json", action="store_true", help="输出JSON（含目录路径和偏移区间）")
+
+    ask_parser = subparsers.add_parser("ask", help="从stdin读取JSONL问题（可带scope字段），向stdout输出JSONL答案")
+    ask_parser.add_argument("--workers", type=int, default=4, help="并发问答线程数")
+    ask_parser.add_argument("--no-ai", action="store_true", help="不调用大模型，只返回检索答案")
+
+    bench_parser = subparsers.add_parser("bench", help="检索性能基准")
+    bench_parser.add_argument("--questions", default=None, help="问题文件（每行一个），默认使用示例问题")
+    bench_parser.add_argument("--repeat", type=int, default=5, help="热查询轮数")
+    bench_parser.add_argument("--top-k", type=int, default=5)
+
+    storage_parser = subparsers.add_parser("bench-storage", help="JSON缓存与mmap紧凑索引的大小、加载和查询对比")
+    storage_parser.add_argument("--output-dir", default=None, help="两种索引文件的输出目录，默认写到临时目录")
+    storage_parser.add_argument("--questions", default=None, help="问题文件（每行一个），默认使用示例问题")
+    storage_parser.add_argument("--repeat", type=int, default=5, help="加载和查询的重复次数")
+
+    subparsers.add_parser("check-facts", help="事实表回归检查（不应直接作答的问题、直接作答的数值）")
+
+    stress_parser = subparsers.add_parser("stress", help="多线程并发问答压力测试（可同时重新加载手册）")
+    stress_parser.add_argument("--threads", default="1,2,4,8", help="逗号分隔的线程数列表")
+    stress_parser.add_argument("--queries", type=int, default=200, help="每轮问答总数")
+    stress_parser.add_argument("--questions", default=None, help="问题文件（每行一个），默认使用示例问题")
+    stress_parser.add_argument("--reload-interval", type=float, default=0.0,
+                               help="后台重新加载手册的间隔秒数，0表示不重新加载")
+    stress_parser.add_argument("--no-cache", action="store_true", help="关闭检索结果缓存")
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    """主函数"""
+    args = build_arg_parser().parse_args(argv)
+    commands = {
+        "build-index": run_build_index,
+        "search": run_search,
+        "section": run_section,
+        "ask": run_ask,
+        "bench": run_bench,
+        "bench-storage": run_bench_storage,
+        "check-facts": run_check_facts,
+        "stress": run_stress
+    }
+    commands.get(args.command, run_chat)(args)
+
+
 if __name__ == "__main__":
     main()